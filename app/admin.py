@@ -1,11 +1,22 @@
 import os
 import logging
 from fastapi import APIRouter, Request, Depends, Form, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 import aiosqlite
-from app.dependencies import get_current_user, role_required
-from app.config import BASE_DIR, DATABASE
+from app.dependencies import get_current_user, role_required, user_cache
+from app.config import BASE_DIR, ANALYTICS_WEEKS
+from app.db import get_db, pool, writer, write, write_execute
+from app.chat_cache import message_cache
+from app.security import hash_password
+from app.auth import login_limiter, login_ip_limiter
+from app.sessions import session_backend
+from app.broker import chat_broker, incident_broker
+from app.blocks import block_index
+from app.messaging import message_batcher
+from app.retention import message_retention
+from app.incident_counters import reconcile as reconcile_incident_counters
+from app.analytics import refresh as refresh_analytics, resolution_report
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -14,10 +25,9 @@ templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "app", "templates")
 
 # Маршрут для просмотра всех пользователей (доступен только администраторам)
 @router.get("/admin/users", response_class=HTMLResponse)
-async def view_users(request: Request, current_user: dict = Depends(role_required(['admin']))):
-    async with aiosqlite.connect(DATABASE) as db:
-        async with db.execute("SELECT id, username, email, role FROM users") as cursor:
-            users = await cursor.fetchall()
+async def view_users(request: Request, current_user: dict = Depends(role_required(['admin'])), db: aiosqlite.Connection = Depends(get_db)):
+    async with db.execute("SELECT id, username, email, role FROM users") as cursor:
+        users = await cursor.fetchall()
     return templates.TemplateResponse("admin_users.html", {"request": request, "users": users, "user": current_user})
 
 # Маршрут для отображения формы создания нового пользователя
@@ -41,12 +51,10 @@ async def create_user(
         return templates.TemplateResponse("admin_create_user.html", {"request": request, "error": error_message, "user": current_user})
 
     try:
-        async with aiosqlite.connect(DATABASE) as db:
-            await db.execute("""
-                INSERT INTO users (username, email, password, role)
-                VALUES (?, ?, ?, ?)
-            """, (username, email, password, role))
-            await db.commit()
+        await write_execute("""
+            INSERT INTO users (username, email, password, role)
+            VALUES (?, ?, ?, ?)
+        """, (username, email, await hash_password(password), role))
         return RedirectResponse(url="/admin/users", status_code=303)
     except aiosqlite.IntegrityError:
         error_message = "Пользователь с таким именем или email уже существует."
@@ -58,12 +66,11 @@ async def create_user(
 
 # Маршрут для отображения формы изменения роли пользователя
 @router.get("/admin/users/{user_id}/edit", response_class=HTMLResponse)
-async def edit_user_form(user_id: int, request: Request, current_user: dict = Depends(role_required(['admin']))):
-    async with aiosqlite.connect(DATABASE) as db:
-        async with db.execute("SELECT id, username, email, role FROM users WHERE id = ?", (user_id,)) as cursor:
-            user_info = await cursor.fetchone()
-            if not user_info:
-                raise HTTPException(status_code=404, detail="Пользователь не найден")
+async def edit_user_form(user_id: int, request: Request, current_user: dict = Depends(role_required(['admin'])), db: aiosqlite.Connection = Depends(get_db)):
+    async with db.execute("SELECT id, username, email, role FROM users WHERE id = ?", (user_id,)) as cursor:
+        user_info = await cursor.fetchone()
+        if not user_info:
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
     return templates.TemplateResponse("admin_edit_user.html", {"request": request, "user_info": user_info, "user": current_user})
 
 # Маршрут для обработки изменения роли пользователя
@@ -79,15 +86,53 @@ async def edit_user(
         error_message = "Недопустимая роль."
         return templates.TemplateResponse("admin_edit_user.html", {"request": request, "error": error_message, "user_info": {"id": user_id}, "user": current_user})
 
-    async with aiosqlite.connect(DATABASE) as db:
-        await db.execute("UPDATE users SET role = ? WHERE id = ?", (role, user_id))
-        await db.commit()
+    await write_execute("UPDATE users SET role = ? WHERE id = ?", (role, user_id))
+    # Новая роль действует сразу, без ожидания истечения кэша
+    user_cache.invalidate(user_id)
     return RedirectResponse(url="/admin/users", status_code=303)
 
 # Маршрут для удаления пользователя
 @router.post("/admin/users/{user_id}/delete")
 async def delete_user(user_id: int, current_user: dict = Depends(role_required(['admin']))):
-    async with aiosqlite.connect(DATABASE) as db:
-        await db.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        await db.commit()
+    await write_execute("DELETE FROM users WHERE id = ?", (user_id,))
+    user_cache.invalidate(user_id)
     return RedirectResponse(url="/admin/users", status_code=303)
+
+
+# Маршрут для просмотра статистики работы сервера (пул соединений и т.п.)
+@router.get("/admin/stats", response_class=JSONResponse)
+async def server_stats(current_user: dict = Depends(role_required(['admin']))):
+    return JSONResponse(content={
+        "db_pool": pool.stats(),
+        "db_writer": writer.stats(),
+        "message_cache": message_cache.stats(),
+        "user_cache": user_cache.stats(),
+        "login_throttle": {"user_ip": login_limiter.stats(), "ip": login_ip_limiter.stats()},
+        "sessions": session_backend.stats(),
+        "chat_stream": chat_broker.stats(),
+        "incident_stream": incident_broker.stats(),
+        "block_index": block_index.stats(),
+        "message_batcher": message_batcher.stats(),
+        "message_retention": message_retention.stats()
+    })
+
+# Сверка счетчиков инцидентов с таблицей incidents (исправляет расхождения)
+@router.post("/admin/incident-counters/reconcile", response_class=JSONResponse)
+async def reconcile_counters(current_user: dict = Depends(role_required(['admin']))):
+    fixed = await write(reconcile_incident_counters)
+    if fixed:
+        logger.warning(f"Исправлено расхождений в счетчиках инцидентов: {fixed}")
+    return JSONResponse(content={"fixed": fixed})
+
+# Аналитика времени решения инцидентов: MTTR, p50/p90/p99 и число закрытых по исполнителям,
+# неделям и путям статусов. Только чтение: отчет строится по данным последнего обновления
+@router.get("/admin/analytics/resolution", response_class=JSONResponse)
+async def resolution_analytics(weeks: int = ANALYTICS_WEEKS, current_user: dict = Depends(role_required(['admin'])), db: aiosqlite.Connection = Depends(get_db)):
+    report = await resolution_report(db, max(1, weeks))
+    return JSONResponse(content=report)
+
+# Обновление аналитики: обрабатывает инциденты, измененные с прошлого запуска (при первом запуске — полный пересчет)
+@router.post("/admin/analytics/resolution/refresh", response_class=JSONResponse)
+async def refresh_resolution_analytics(current_user: dict = Depends(role_required(['admin']))):
+    processed = await refresh_analytics()
+    return JSONResponse(content={"processed": processed})
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import time
+
+import aiosqlite
+
+from app import db as appdb
+from app.config import ANALYTICS_BATCH_SIZE, ANALYTICS_WEEKS
+
+logger = logging.getLogger(__name__)
+
+# Аналитика времени решения инцидентов. Закрытые инциденты раскладываются в resolution_facts
+# (строка на инцидент), а их сумма — в гистограмму resolution_histogram по измерениям:
+# all (вся очередь), assignee (исполнитель), week (неделя закрытия, дата понедельника), path (путь статусов).
+# Все вычисления — пакетные SQL-запросы по ANALYTICS_BATCH_SIZE инцидентов; обновление инкрементальное:
+# обрабатываются только инциденты, измененные после прошлого запуска (отметка в analytics_state)
+
+STATE_NAME = "resolution"
+
+# Корзина гистограммы: время решения в минутах, округленное вниз до трех значащих цифр
+# (до 1000 минут — точно). Корзина не меньше 100 единиц своего шага, поэтому процентили по корзинам
+# меньше точных менее чем на 1%. При смене округления аналитика пересчитывается миграцией
+BUCKET_SQL = """
+    CASE WHEN minutes < 1000 THEN minutes
+    ELSE minutes / CAST('1' || substr('0000000000000000', 1, length(minutes) - 3) AS INTEGER)
+                 * CAST('1' || substr('0000000000000000', 1, length(minutes) - 3) AS INTEGER)
+    END
+"""
+
+# Вклад фактов, отобранных условием condition (по f.incident_id), во все измерения гистограммы
+DIMENSIONS_SQL = """
+    SELECT 'all' AS dimension, '' AS key, f.bucket, f.minutes FROM resolution_facts f WHERE {condition}
+    UNION ALL
+    SELECT 'assignee', CAST(f.assignee_id AS TEXT), f.bucket, f.minutes FROM resolution_facts f WHERE {condition}
+    UNION ALL
+    SELECT 'week', f.week, f.bucket, f.minutes FROM resolution_facts f WHERE {condition}
+    UNION ALL
+    SELECT 'path', f.path, f.bucket, f.minutes FROM resolution_facts f WHERE {condition}
+"""
+
+# Условия отбора инцидентов: список id (JSON-массив) или диапазон id (lo, hi]
+BATCH_CONDITION = "{column} IN (SELECT value FROM json_each(?))"
+RANGE_CONDITION = "{column} > ? AND {column} <= ?"
+
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+
+
+# Добавляет (sign = 1) или вычитает (sign = -1) из гистограммы вклад фактов, отобранных условием
+async def _apply_facts(db: aiosqlite.Connection, condition: str, params: tuple, sign: int):
+    await db.execute(f"""
+        INSERT INTO resolution_histogram (dimension, key, bucket, count, minutes)
+        SELECT dimension, key, bucket, ? * COUNT(*), ? * SUM(minutes)
+        FROM ({DIMENSIONS_SQL.format(condition=condition.format(column="f.incident_id"))})
+        GROUP BY dimension, key, bucket
+        ON CONFLICT(dimension, key, bucket) DO UPDATE SET
+            count = count + excluded.count,
+            minutes = minutes + excluded.minutes
+    """, (sign, sign, *params * 4))
+
+
+# Заносит в resolution_facts закрытые инциденты, отобранные условием
+async def _insert_facts(db: aiosqlite.Connection, condition: str, params: tuple):
+    await db.execute(f"""
+        INSERT INTO resolution_facts (incident_id, assignee_id, week, path, minutes, bucket)
+        SELECT id, assignee_id, week, path, minutes, {BUCKET_SQL}
+        FROM (
+            SELECT
+                id,
+                COALESCE(assignee_id, 0) AS assignee_id,
+                date(updated_at, '-6 days', 'weekday 1') AS week,
+                COALESCE(status_path, 'unknown') AS path,
+                max(resolution_time, 0) AS minutes
+            FROM incidents
+            WHERE {condition.format(column="id")} AND status = 'closed' AND resolution_time IS NOT NULL
+        )
+    """, params)
+
+
+async def _save_state(db: aiosqlite.Connection, updated_at: str, incident_id: int):
+    await db.execute("""
+        INSERT INTO analytics_state (name, updated_at, incident_id) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET updated_at = excluded.updated_at, incident_id = excluded.incident_id
+    """, (STATE_NAME, updated_at, incident_id))
+
+
+# Начало полного пересчета: очищает факты и гистограмму и ставит отметку на текущий момент —
+# инциденты, измененные во время пересчета, затем обработает инкрементальное обновление.
+# Возвращает максимальный id инцидента
+async def start_rebuild(db: aiosqlite.Connection) -> int:
+    await db.execute("DELETE FROM resolution_facts")
+    await db.execute("DELETE FROM resolution_histogram")
+    async with db.execute("SELECT MAX(updated_at), MAX(id) FROM incidents") as cursor:
+        max_updated_at, max_id = await cursor.fetchone()
+    await _save_state(db, max_updated_at or "", 0)
+    return max_id or 0
+
+
+# Начинает полный пересчет, только если отметки еще нет (первый запуск). Проверка и очистка идут
+# в одной транзакции writer, поэтому из параллельных обновлений пересчет начнет только одно.
+# Возвращает максимальный id инцидента или None, если отметка уже есть
+async def start_rebuild_if_missing(db: aiosqlite.Connection):
+    async with db.execute("SELECT 1 FROM analytics_state WHERE name = ?", (STATE_NAME,)) as cursor:
+        if await cursor.fetchone() is not None:
+            return None
+    return await start_rebuild(db)
+
+
+# Пачка полного пересчета: инциденты с id в (lo, hi] читаются последовательно по первичному ключу.
+# Прежний вклад диапазона сначала вычитается: его могли уже заполнить параллельный пересчет
+# (в том числе из другого процесса) или инкрементальное обновление, запущенное во время пересчета
+async def rebuild_range(db: aiosqlite.Connection, lo: int, hi: int):
+    await _apply_facts(db, RANGE_CONDITION, (lo, hi), -1)
+    await db.execute(f"DELETE FROM resolution_facts WHERE {RANGE_CONDITION.format(column='incident_id')}", (lo, hi))
+    await _insert_facts(db, RANGE_CONDITION, (lo, hi))
+    await _apply_facts(db, RANGE_CONDITION, (lo, hi), 1)
+    await db.execute("DELETE FROM resolution_histogram WHERE count = 0")
+
+
+# Обрабатывает следующую пачку инцидентов, измененных после отметки (updated_at, id), в одной транзакции writer.
+# Инциденты последней секунды прошлого запуска обрабатываются повторно (изменения в ту же секунду не теряются);
+# это безопасно: старый вклад инцидента сначала вычитается. Возвращает число обработанных инцидентов
+async def refresh_batch(db: aiosqlite.Connection, batch_size: int) -> int:
+    async with db.execute(
+        "SELECT updated_at, incident_id FROM analytics_state WHERE name = ?", (STATE_NAME,)
+    ) as cursor:
+        state = await cursor.fetchone()
+    after = state or ("", 0)
+    async with db.execute("""
+        SELECT id, updated_at FROM incidents
+        WHERE (updated_at, id) > (?, ?)
+        ORDER BY updated_at, id
+        LIMIT ?
+    """, (after[0], after[1], batch_size)) as cursor:
+        rows = await cursor.fetchall()
+    if not rows:
+        if after[1]:
+            # Последняя пачка прошлого запуска была полной: следующий начнется с начала ее последней секунды
+            await db.execute("UPDATE analytics_state SET incident_id = 0 WHERE name = ?", (STATE_NAME,))
+        return 0
+    batch = (json.dumps([row[0] for row in rows]),)
+    await _apply_facts(db, BATCH_CONDITION, batch, -1)
+    await db.execute("DELETE FROM resolution_facts WHERE incident_id IN (SELECT value FROM json_each(?))", batch)
+    await _insert_facts(db, BATCH_CONDITION, batch)
+    await _apply_facts(db, BATCH_CONDITION, batch, 1)
+    await db.execute("DELETE FROM resolution_histogram WHERE count = 0")
+    last_id, last_updated_at = rows[-1]
+    if len(rows) < batch_size:
+        # Дочитали до конца: следующий запуск начнется с начала последней секунды
+        last_id = 0
+    await _save_state(db, last_updated_at, last_id)
+    return len(rows)
+
+
+async def _rebuild_ranges(max_id: int, batch_size: int):
+    for lo in range(0, max_id, batch_size):
+        await appdb.write(rebuild_range, lo, lo + batch_size)
+        await asyncio.sleep(0)
+
+
+# Полный пересчет по диапазонам id (каждый — отдельное задание writer), затем инкрементальное обновление
+async def rebuild(batch_size: int = ANALYTICS_BATCH_SIZE) -> int:
+    max_id = await appdb.write(start_rebuild)
+    await _rebuild_ranges(max_id, batch_size)
+    await refresh(batch_size)
+    return max_id
+
+
+# Инкрементальное обновление: пачки по batch_size, каждая — отдельное задание writer.
+# При первом запуске — полный пересчет. Возвращает число обработанных инцидентов
+async def refresh(batch_size: int = ANALYTICS_BATCH_SIZE) -> int:
+    max_id = await appdb.write(start_rebuild_if_missing)
+    if max_id is not None:
+        await _rebuild_ranges(max_id, batch_size)
+    processed = max_id or 0
+    while True:
+        count = await appdb.write(refresh_batch, batch_size)
+        processed += count
+        if count < batch_size:
+            return processed
+        await asyncio.sleep(0)
+
+
+def _summary(buckets: list) -> dict:
+    count = sum(bucket_count for _, bucket_count, _ in buckets)
+    minutes = sum(bucket_minutes for _, _, bucket_minutes in buckets)
+    summary = {"count": count, "mttr": round(minutes / count, 1) if count else None}
+    for name, fraction in PERCENTILES:
+        rank = max(1, math.ceil(count * fraction))
+        cumulative = 0
+        summary[name] = None
+        for bucket, bucket_count, _ in buckets:
+            cumulative += bucket_count
+            if cumulative >= rank:
+                summary[name] = bucket
+                break
+    return summary
+
+
+# Сводка по гистограмме: MTTR (среднее, минут), p50/p90/p99 (минут) и число закрытых инцидентов
+# по всей очереди, по исполнителям, по неделям (последние weeks) и по путям статусов
+async def resolution_report(db: aiosqlite.Connection, weeks: int = ANALYTICS_WEEKS) -> dict:
+    async with db.execute("""
+        SELECT dimension, key, bucket, count, minutes FROM resolution_histogram
+        ORDER BY dimension, key, bucket
+    """) as cursor:
+        rows = await cursor.fetchall()
+    groups = {}
+    for dimension, key, bucket, count, minutes in rows:
+        groups.setdefault(dimension, {}).setdefault(key, []).append((bucket, count, minutes))
+    assignee_ids = [int(key) for key in groups.get("assignee", {}) if key != "0"]
+    usernames = {}
+    if assignee_ids:
+        async with db.execute(
+            "SELECT id, username FROM users WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(assignee_ids),)
+        ) as cursor:
+            usernames = dict(await cursor.fetchall())
+    by_week = sorted(groups.get("week", {}).items(), reverse=True)[:weeks]
+    return {
+        "all": _summary(groups.get("all", {}).get("", [])),
+        "by_assignee": [
+            {"assignee_id": int(key) or None, "username": usernames.get(int(key)), **_summary(buckets)}
+            for key, buckets in groups.get("assignee", {}).items()
+        ],
+        "by_week": [{"week": key, **_summary(buckets)} for key, buckets in by_week],
+        "by_path": [{"path": key, **_summary(buckets)} for key, buckets in groups.get("path", {}).items()],
+    }
+
+
+async def run_report(weeks: int) -> dict:
+    try:
+        started = time.perf_counter()
+        processed = await refresh()
+        logger.info(f"Обработано инцидентов: {processed} за {time.perf_counter() - started:.2f} с")
+        async with appdb.pool.acquire() as db:
+            return await resolution_report(db, weeks)
+    finally:
+        await appdb.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Аналитика времени решения инцидентов (MTTR, процентили, пропускная способность)")
+    parser.add_argument("--weeks", type=int, default=ANALYTICS_WEEKS, help="Число последних недель в отчете")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run_report(args.weeks)), ensure_ascii=False, indent=2))
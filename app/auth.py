@@ -1,9 +1,18 @@
 import os
+import math
 import logging
 from fastapi import APIRouter, Request, Form, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 import aiosqlite
+from app.config import (
+    LOGIN_THROTTLE_ATTEMPTS, LOGIN_THROTTLE_IP_ATTEMPTS, LOGIN_THROTTLE_WINDOW,
+    LOGIN_THROTTLE_MAX_KEYS, LOGIN_THROTTLE_SWEEP_INTERVAL
+)
+from app.db import get_db, pool, write_execute
+from app.dependencies import load_user
+from app.security import hash_password, verify_password
+from app.throttle import SlidingWindowLimiter
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -17,23 +26,79 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 templates2 = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates2"))
 
-# Путь к файлу базы данных
-DATABASE = os.path.join(BASE_DIR, "..", "database", "database.db")
+# Ограничение попыток входа по паре логин+IP и отдельно по IP (перебор разных логинов с одного адреса).
+# Проверяется до обращения к базе и хеширования пароля; успешный вход из окон не вычитается,
+# поэтому ограничиваются только неудачные попытки (много сотрудников за одним NAT могут войти одновременно)
+login_limiter = SlidingWindowLimiter(
+    LOGIN_THROTTLE_ATTEMPTS, LOGIN_THROTTLE_WINDOW, LOGIN_THROTTLE_MAX_KEYS, LOGIN_THROTTLE_SWEEP_INTERVAL
+)
+login_ip_limiter = SlidingWindowLimiter(
+    LOGIN_THROTTLE_IP_ATTEMPTS, LOGIN_THROTTLE_WINDOW, LOGIN_THROTTLE_MAX_KEYS, LOGIN_THROTTLE_SWEEP_INTERVAL
+)
+
+def _login_throttle_key(request: Request, username: str):
+    ip = request.client.host if request.client else ""
+    # Длина логина в ключе ограничена, чтобы мусорные значения не раздували память
+    return username[:64].lower(), ip
+
+# Учитывает попытку входа; возвращает 0 или через сколько секунд можно повторить.
+# Попытка учитывается сразу, до проверки пароля, чтобы параллельные запросы не обходили ограничение
+def throttle_login(request: Request, username: str) -> float:
+    key = _login_throttle_key(request, username)
+    return login_ip_limiter.hit(key[1]) or login_limiter.hit(key)
+
+# Успешный вход: сбрасывает счетчик пары логин+IP и возвращает попытку в окно IP
+def login_succeeded(request: Request, username: str):
+    key = _login_throttle_key(request, username)
+    login_limiter.reset(key)
+    login_ip_limiter.refund(key[1])
+
+def _too_many_attempts(templates: Jinja2Templates, request: Request, retry_after: float):
+    retry_after = max(1, math.ceil(retry_after))
+    error_message = f"Слишком много попыток входа. Повторите через {retry_after} с."
+    return templates.TemplateResponse(
+        "login.html", {"request": request, "error": error_message},
+        status_code=429, headers={"Retry-After": str(retry_after)}
+    )
 
 # Функция для получения текущего пользователя
-async def get_current_user(request: Request):
+async def get_current_user(request: Request, db: aiosqlite.Connection = Depends(get_db)):
     user_id = request.session.get('user_id')
     if user_id:
         try:
-            async with aiosqlite.connect(DATABASE) as db:
-                async with db.execute("SELECT id, username, role FROM users WHERE id = ?", (user_id,)) as cursor:
-                    user = await cursor.fetchone()
-                    if user:
-                        return {"id": user[0], "username": user[1], "role": user[2]}
+            user = await load_user(db, user_id)
+            if user:
+                return dict(user)
         except Exception as e:
             logger.error(f"Ошибка при получении пользователя: {e}")
     return None
 
+# Проверяет логин и пароль; возвращает (id, role) или None.
+# Пароль, сохраненный открытым текстом или с устаревшей стоимостью, пересохраняется как хеш.
+# Соединение из пула нужно только для чтения строки пользователя: проверка хеша и пересохранение
+# идут уже без него, иначе одновременные входы заняли бы весь пул на время хеширования
+async def authenticate(username: str, password: str):
+    async with pool.acquire() as db:
+        async with db.execute(
+            "SELECT id, password, role FROM users WHERE username = ?", (username,)
+        ) as cursor:
+            user = await cursor.fetchone()
+    if not user:
+        return None
+    valid, needs_upgrade = await verify_password(password, user[1])
+    if not valid:
+        return None
+    if needs_upgrade:
+        try:
+            # Условие на старое значение: параллельный вход не перезапишет уже обновленный хеш
+            await write_execute(
+                "UPDATE users SET password = ? WHERE id = ? AND password = ?",
+                (await hash_password(password), user[0], user[1])
+            )
+        except Exception as e:
+            logger.error(f"Не удалось обновить хеш пароля пользователя {user[0]}: {e}")
+    return user[0], user[2]
+
 # Маршрут для страницы регистрации (GET)
 @router.get("/register", response_class=HTMLResponse)
 async def register_get(request: Request):
@@ -49,13 +114,11 @@ async def register_post(
 ):
     logger.info(f"Получены данные регистрации: username={username}, email={email}")
     try:
-        async with aiosqlite.connect(DATABASE) as db:
-            # Добавляем нового пользователя с ролью 'user'
-            await db.execute(
-                "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, 'user')",
-                (username, email, password)
-            )
-            await db.commit()
+        # Добавляем нового пользователя с ролью 'user'
+        await write_execute(
+            "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, 'user')",
+            (username, email, await hash_password(password))
+        )
         return RedirectResponse(url="/login", status_code=303)
     except aiosqlite.IntegrityError as e:
         # Логируем подробное сообщение об ошибке
@@ -80,16 +143,19 @@ async def login_post(
     username: str = Form(...),
     password: str = Form(...)
 ):
+    retry_after = throttle_login(request, username)
+    if retry_after:
+        return _too_many_attempts(templates, request, retry_after)
     try:
-        async with aiosqlite.connect(DATABASE) as db:
-            async with db.execute(
-                "SELECT id, password, role FROM users WHERE username = ?", (username,)
-            ) as cursor:
-                user = await cursor.fetchone()
-                if user and user[1] == password and user[2] != 'user':
-                    # Устанавливаем пользователя в сессии
-                    request.session['user_id'] = user[0]
-                    return RedirectResponse(url="/", status_code=303)
+        # Соединение из пула берется только после проверки ограничения
+        user = await authenticate(username, password)
+        if user and user[1] != 'user':
+            login_succeeded(request, username)
+            # Новый идентификатор сессии при входе (защита от фиксации сессии)
+            request.session.regenerate()
+            # Устанавливаем пользователя в сессии
+            request.session['user_id'] = user[0]
+            return RedirectResponse(url="/", status_code=303)
         # Неверные учетные данные
         error_message = "Неверное имя пользователя или пароль."
         return templates.TemplateResponse("login.html", {"request": request, "error": error_message})
@@ -138,16 +204,19 @@ async def login_post(
     username: str = Form(...),
     password: str = Form(...)
 ):
+    retry_after = throttle_login(request, username)
+    if retry_after:
+        return _too_many_attempts(templates2, request, retry_after)
     try:
-        async with aiosqlite.connect(DATABASE) as db:
-            async with db.execute(
-                "SELECT id, password, role FROM users WHERE username = ?", (username,)
-            ) as cursor:
-                user = await cursor.fetchone()
-                if user and user[1] == password and user[2] == 'user':
-                    # Устанавливаем пользователя в сессии
-                    request.session['user_id'] = user[0]
-                    return RedirectResponse(url="/", status_code=303)
+        # Соединение из пула берется только после проверки ограничения
+        user = await authenticate(username, password)
+        if user and user[1] == 'user':
+            login_succeeded(request, username)
+            # Новый идентификатор сессии при входе (защита от фиксации сессии)
+            request.session.regenerate()
+            # Устанавливаем пользователя в сессии
+            request.session['user_id'] = user[0]
+            return RedirectResponse(url="/", status_code=303)
         # Неверные учетные данные
         error_message = "Неверное имя пользователя или пароль."
         return templates2.TemplateResponse("login.html", {"request": request, "error": error_message})
@@ -170,13 +239,11 @@ async def register_post(
 ):
     logger.info(f"Получены данные регистрации: username={username}, email={email}")
     try:
-        async with aiosqlite.connect(DATABASE) as db:
-            # Добавляем нового пользователя с ролью 'user'
-            await db.execute(
-                "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, 'user')",
-                (username, email, password)
-            )
-            await db.commit()
+        # Добавляем нового пользователя с ролью 'user'
+        await write_execute(
+            "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, 'user')",
+            (username, email, await hash_password(password))
+        )
         return RedirectResponse(url="/login", status_code=303)
     except aiosqlite.IntegrityError as e:
         # Логируем подробное сообщение об ошибке
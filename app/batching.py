@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+
+from app.db import write
+from app.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы размеров пачек
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+# Групповая запись: элементы от параллельных запросов копятся до window секунд или до max_size штук
+# и записываются одним заданием writer — одной транзакцией с одним commit.
+# job(db, items) должен вернуть список результатов в порядке items. Вызывающий ждет,
+# пока транзакция его пачки не будет зафиксирована
+class GroupCommitter:
+    def __init__(self, job, window: float, max_size: int):
+        self.job = job
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+        self.failures = 0
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.commit_latency = Histogram()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush_pending)
+        return await future
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        try:
+            results = await write(self.job, [item for item, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # Ошибка одного элемента не должна отменять остальные: повторяем по одному
+                logger.warning(f"Ошибка групповой записи ({len(batch)} шт.), повтор по одному: {e}")
+                for entry in batch:
+                    await self._flush([entry])
+                return
+            self.failures += 1
+            item, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.commit_latency.observe(time.perf_counter() - started)
+        self.batch_size.observe(len(batch))
+        self.batches += 1
+        self.items += len(batch)
+        for (item, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "window": self.window,
+            "max_size": self.max_size,
+            "batches": self.batches,
+            "items": self.items,
+            "failures": self.failures,
+            "pending": len(self._pending),
+            "batch_size": self.batch_size.stats(),
+            "commit_latency": self.commit_latency.stats(),
+        }
@@ -0,0 +1,48 @@
+import aiosqlite
+
+from app.cache import TTLCache
+from app.config import BLOCK_INDEX_SIZE, BLOCK_INDEX_TTL
+
+
+# Индекс блокировок в памяти: для пользователя хранится множество заблокированных им пользователей.
+# Загружается лениво по пользователю и обновляется обработчиками block/unblock этого процесса;
+# изменения из других процессов видны не позже чем через TTL
+class BlockIndex:
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl)
+        # Счетчик изменений: загрузка, во время которой что-то изменилось, не попадает в кэш
+        self._updates = 0
+
+    # Множество пользователей, заблокированных user_id
+    async def block_list(self, db: aiosqlite.Connection, user_id: int) -> frozenset:
+        blocked = self._cache.get(user_id)
+        if blocked is not None:
+            return blocked
+        updates = self._updates
+        async with db.execute("SELECT blocked_user_id FROM blocked_users WHERE user_id = ?", (user_id,)) as cursor:
+            blocked = frozenset(row[0] for row in await cursor.fetchall())
+        if updates == self._updates:
+            self._cache.set(user_id, blocked)
+        return blocked
+
+    # Заблокирован ли user_id пользователем by_user_id
+    async def is_blocked(self, db: aiosqlite.Connection, user_id: int, by_user_id: int) -> bool:
+        return user_id in await self.block_list(db, by_user_id)
+
+    def block(self, user_id: int, blocked_user_id: int):
+        self._updates += 1
+        blocked = self._cache.get(user_id)
+        if blocked is not None:
+            self._cache.set(user_id, blocked | {blocked_user_id})
+
+    def unblock(self, user_id: int, blocked_user_id: int):
+        self._updates += 1
+        blocked = self._cache.get(user_id)
+        if blocked is not None:
+            self._cache.set(user_id, blocked - {blocked_user_id})
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+block_index = BlockIndex(BLOCK_INDEX_SIZE, BLOCK_INDEX_TTL)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+from app.config import CHAT_STREAM_QUEUE_SIZE, INCIDENT_STREAM_QUEUE_SIZE
+from app.metrics import Histogram
+
+
+# Подписка на тему брокера: ограниченная очередь событий одного соединения
+class Subscription:
+    def __init__(self, broker, key, maxsize: int):
+        self.broker = broker
+        self.key = key
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = False
+
+    # Следующее событие или None, если подписчик отключен брокером за отставание.
+    # Без события за timeout секунд — asyncio.TimeoutError
+    async def get(self, timeout: float = None):
+        item = await asyncio.wait_for(self.queue.get(), timeout)
+        if item is None:
+            return None
+        published_at, event = item
+        self.broker.fanout_latency.observe(time.perf_counter() - published_at)
+        return event
+
+
+# Брокер публикации/подписки внутри процесса: события темы (например, переписки) рассылаются
+# всем ее подписчикам. Медленный подписчик, чья очередь переполнена, отключается, а не задерживает остальных;
+# клиент переподключается и дочитывает пропущенное из базы
+class Broker:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._topics = {}
+        self.connections = 0
+        self.connections_total = 0
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.fanout_latency = Histogram()
+
+    @contextmanager
+    def subscribe(self, key):
+        subscription = Subscription(self, key, self.queue_size)
+        self._topics.setdefault(key, set()).add(subscription)
+        self.connections += 1
+        self.connections_total += 1
+        try:
+            yield subscription
+        finally:
+            self.connections -= 1
+            self._remove(subscription)
+
+    def _remove(self, subscription: Subscription):
+        subscribers = self._topics.get(subscription.key)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._topics[subscription.key]
+
+    # Рассылает событие подписчикам темы без ожидания; возвращает число получателей
+    def publish(self, key, event) -> int:
+        self.published += 1
+        subscribers = self._topics.get(key)
+        if not subscribers:
+            return 0
+        item = (time.perf_counter(), event)
+        delivered = 0
+        for subscription in list(subscribers):
+            try:
+                subscription.queue.put_nowait(item)
+                delivered += 1
+            except asyncio.QueueFull:
+                self._drop(subscription)
+        self.delivered += delivered
+        return delivered
+
+    def _drop(self, subscription: Subscription):
+        self.dropped += 1
+        subscription.dropped = True
+        self._remove(subscription)
+        # Очередь заменяется маркером отключения: подписчик сразу узнает, что нужно переподключиться
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.connections,
+            "connections_total": self.connections_total,
+            "topics": len(self._topics),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "fanout_latency": self.fanout_latency.stats(),
+        }
+
+
+# Брокер событий чата; тема — ключ переписки MessageCache.key(a, b)
+chat_broker = Broker(CHAT_STREAM_QUEUE_SIZE)
+
+# Брокер изменений инцидентов для живой доски; одна тема INCIDENTS_TOPIC, событие — дельта журнала incident_events
+INCIDENTS_TOPIC = "incidents"
+incident_broker = Broker(INCIDENT_STREAM_QUEUE_SIZE)
@@ -0,0 +1,63 @@
+import aiosqlite
+
+
+# Приводит позиции корзины к виду {service_id: количество}; повторяющиеся услуги объединяются.
+# items — словарь корзины из сессии или последовательность пар (service_id, количество)
+def merge_items(items) -> dict:
+    if isinstance(items, dict):
+        items = items.items()
+    merged = {}
+    for service_id, quantity in items:
+        service_id, quantity = int(service_id), int(quantity)
+        if quantity <= 0:
+            raise ValueError(f"Некорректное количество для услуги {service_id}: {quantity}")
+        merged[service_id] = merged.get(service_id, 0) + quantity
+    return merged
+
+
+# Оценивает корзину одним запросом к services.
+# Возвращает (позиции в порядке корзины, общая стоимость, id не найденных услуг).
+# category — допустимая категория услуг (None — любая)
+async def price_cart(db: aiosqlite.Connection, items: dict, category: str = None):
+    if not items:
+        return [], 0.0, []
+    placeholders = ", ".join("?" * len(items))
+    sql = f"SELECT id, name, price, price_per FROM services WHERE id IN ({placeholders})"
+    params = list(items)
+    if category is not None:
+        sql += " AND category = ?"
+        params.append(category)
+    async with db.execute(sql, params) as cursor:
+        services = {row[0]: row for row in await cursor.fetchall()}
+    lines, total_price, missing = [], 0.0, []
+    for service_id, quantity in items.items():
+        service = services.get(service_id)
+        if service is None:
+            missing.append(service_id)
+            continue
+        subtotal = service[2] * quantity
+        total_price += subtotal
+        lines.append({
+            'service_id': service[0],
+            'name': service[1],
+            'price': service[2],
+            'price_per': service[3],
+            'quantity': quantity,
+            'subtotal': subtotal
+        })
+    return lines, total_price, missing
+
+
+# Создает заявку на услуги с уже оцененными позициями; выполняется внутри задания writer,
+# поэтому заявка и ее позиции записываются одной транзакцией
+async def insert_service_request(db: aiosqlite.Connection, user_id: int, lines: list, total_price: float) -> int:
+    cursor = await db.execute("""
+        INSERT INTO service_requests (user_id, request_date, status, total_price)
+        VALUES (?, datetime('now'), 'Pending', ?)
+    """, (user_id, total_price))
+    request_id = cursor.lastrowid
+    await db.executemany("""
+        INSERT INTO service_cart_items (request_id, service_id, quantity)
+        VALUES (?, ?, ?)
+    """, [(request_id, line['service_id'], line['quantity']) for line in lines])
+    return request_id
@@ -0,0 +1,153 @@
+from collections import OrderedDict, deque
+
+import aiosqlite
+
+from app.config import MESSAGE_CACHE_CONVERSATIONS, MESSAGE_CACHE_SIZE
+
+# Сообщение в кэше: (id, sender_id, receiver_id, content, timestamp)
+_COLUMNS = "id, sender_id, receiver_id, content, timestamp"
+
+
+class _Conversation:
+    __slots__ = ("messages", "complete", "synced_id")
+
+    def __init__(self, messages, complete: bool, synced_id: int, size: int):
+        self.messages = deque(messages, maxlen=size)
+        # True, если в буфере вся переписка, а не только последние сообщения
+        self.complete = complete
+        # Последний id сообщения (по всей таблице), до которого буфер синхронизирован с базой
+        self.synced_id = synced_id
+
+
+# Кольцевой буфер последних сообщений для каждой переписки с LRU-вытеснением переписок.
+# Новые сообщения из других процессов обнаруживаются по sqlite_sequence (одна строка),
+# после чего из базы дочитываются только новые строки.
+class MessageCache:
+    def __init__(self, max_conversations: int, size: int):
+        self.max_conversations = max_conversations
+        self.size = size
+        self._conversations = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.delta_loads = 0
+
+    @staticmethod
+    def key(user_a: int, user_b: int) -> tuple:
+        return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+    @staticmethod
+    async def _last_message_id(db: aiosqlite.Connection) -> int:
+        async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'") as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def _load_latest(self, db: aiosqlite.Connection, user_a: int, user_b: int):
+        # Последние size + 1 сообщений: лишнее сообщение показывает, что история длиннее буфера
+        async with db.execute(f"""
+            SELECT {_COLUMNS} FROM (
+                SELECT * FROM (
+                    SELECT {_COLUMNS} FROM messages WHERE sender_id = ? AND receiver_id = ?
+                    ORDER BY id DESC LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT {_COLUMNS} FROM messages WHERE sender_id = ? AND receiver_id = ?
+                    ORDER BY id DESC LIMIT ?
+                )
+            )
+            ORDER BY id DESC LIMIT ?
+        """, (user_a, user_b, self.size + 1, user_b, user_a, self.size + 1, self.size + 1)) as cursor:
+            rows = await cursor.fetchall()
+        complete = len(rows) <= self.size
+        return list(reversed(rows[:self.size])), complete
+
+    @staticmethod
+    async def _load_after(db: aiosqlite.Connection, user_a: int, user_b: int, after_id: int):
+        # Просматриваются только строки, добавленные после синхронизации (поиск по rowid);
+        # унарный "+" не дает планировщику выбрать индекс переписки
+        async with db.execute(f"""
+            SELECT {_COLUMNS} FROM messages
+            WHERE id > ?
+              AND ((+sender_id = ? AND +receiver_id = ?) OR (+sender_id = ? AND +receiver_id = ?))
+            ORDER BY id ASC
+        """, (after_id, user_a, user_b, user_b, user_a)) as cursor:
+            return await cursor.fetchall()
+
+    def _append(self, conversation: _Conversation, message: tuple):
+        if conversation.messages and message[0] <= conversation.messages[-1][0]:
+            return
+        if len(conversation.messages) == self.size:
+            # Самое старое сообщение вытесняется — буфер больше не содержит всю историю
+            conversation.complete = False
+        conversation.messages.append(message)
+
+    # Возвращает буфер переписки, синхронизированный с базой
+    async def _sync(self, db: aiosqlite.Connection, user_a: int, user_b: int) -> _Conversation:
+        key = self.key(user_a, user_b)
+        last_id = await self._last_message_id(db)
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            self.misses += 1
+            messages, complete = await self._load_latest(db, user_a, user_b)
+            conversation = _Conversation(messages, complete, last_id, self.size)
+            self._conversations[key] = conversation
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+        else:
+            self.hits += 1
+            self._conversations.move_to_end(key)
+            if last_id > conversation.synced_id:
+                # В базе появились новые сообщения (возможно, в другой переписке) — дочитываем дельту
+                self.delta_loads += 1
+                for message in await self._load_after(db, user_a, user_b, conversation.synced_id):
+                    self._append(conversation, tuple(message))
+                conversation.synced_id = last_id
+        return conversation
+
+    # Возвращает (последние сообщения переписки по возрастанию id, покрывает ли буфер всю историю)
+    async def recent(self, db: aiosqlite.Connection, user_a: int, user_b: int):
+        conversation = await self._sync(db, user_a, user_b)
+        return list(conversation.messages), conversation.complete
+
+    # Сообщения переписки с id > since_id по возрастанию id или None, если буфер не покрывает
+    # этот диапазон. Просматривается только хвост буфера, поэтому стоимость зависит от числа новых сообщений
+    async def since(self, db: aiosqlite.Connection, user_a: int, user_b: int, since_id: int):
+        conversation = await self._sync(db, user_a, user_b)
+        messages = conversation.messages
+        if not conversation.complete and (not messages or messages[0][0] > since_id):
+            return None
+        newer = []
+        for message in reversed(messages):
+            if message[0] <= since_id:
+                break
+            newer.append(message)
+        newer.reverse()
+        return newer
+
+    # Сквозная запись: вызывается после успешной вставки сообщения
+    def add(self, message: tuple):
+        conversation = self._conversations.get(self.key(message[1], message[2]))
+        if conversation is None:
+            return
+        # Добавляется только сообщение, следующее сразу за синхронизацией. Иначе между ними есть сообщения
+        # (например, из другого процесса), и более раннее из них потерялось бы: _append пропускает id не больше
+        # последнего в буфере. Такое сообщение дочитает _sync вместе с пропущенными
+        if message[0] == conversation.synced_id + 1:
+            self._append(conversation, message)
+            conversation.synced_id = message[0]
+
+    def invalidate(self, user_a: int, user_b: int):
+        self._conversations.pop(self.key(user_a, user_b), None)
+
+    def stats(self) -> dict:
+        return {
+            "conversations": len(self._conversations),
+            "max_conversations": self.max_conversations,
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "delta_loads": self.delta_loads,
+        }
+
+
+message_cache = MessageCache(MESSAGE_CACHE_CONVERSATIONS, MESSAGE_CACHE_SIZE)
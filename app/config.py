@@ -6,5 +6,115 @@ CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
 # Получаем базовую директорию проекта
 BASE_DIR = os.path.dirname(CONFIG_DIR)
 
-# Путь к файлу базы данных
-DATABASE = os.path.join(BASE_DIR, "database", "database.db")
\ No newline at end of file
+# Путь к файлу базы данных (можно переопределить переменной окружения)
+DATABASE = os.environ.get("ITSM_DATABASE", os.path.join(BASE_DIR, "database", "database.db"))
+
+# Количество соединений в пуле
+DB_POOL_SIZE = int(os.environ.get("ITSM_DB_POOL_SIZE", "5"))
+
+# Режим хранения: WAL и параметры SQLite для всех соединений приложения
+DB_JOURNAL_MODE = os.environ.get("ITSM_DB_JOURNAL_MODE", "wal")
+DB_SYNCHRONOUS = os.environ.get("ITSM_DB_SYNCHRONOUS", "normal")
+DB_CACHE_SIZE = int(os.environ.get("ITSM_DB_CACHE_SIZE", "-16000"))  # отрицательное значение — в КиБ
+DB_MMAP_SIZE = int(os.environ.get("ITSM_DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_BUSY_TIMEOUT = int(os.environ.get("ITSM_DB_BUSY_TIMEOUT", "5000"))  # мс
+
+# Применять ли недостающие миграции схемы при запуске приложения
+DB_MIGRATE_ON_STARTUP = os.environ.get("ITSM_DB_MIGRATE_ON_STARTUP", "1") == "1"
+
+# Кэш последних сообщений: число переписок в памяти и длина буфера каждой
+MESSAGE_CACHE_CONVERSATIONS = int(os.environ.get("ITSM_MESSAGE_CACHE_CONVERSATIONS", "1000"))
+MESSAGE_CACHE_SIZE = int(os.environ.get("ITSM_MESSAGE_CACHE_SIZE", "200"))
+
+# Кэш текущего пользователя (id, username, role): размер и время жизни записи в секундах
+USER_CACHE_SIZE = int(os.environ.get("ITSM_USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("ITSM_USER_CACHE_TTL", "60"))
+
+# Хеширование паролей: число итераций PBKDF2 и размер пула потоков для хеширования
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("ITSM_PASSWORD_HASH_ITERATIONS", "260000"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("ITSM_PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Ограничение попыток входа (скользящее окно): попыток на пару логин+IP и на один IP за окно в секундах,
+# максимум отслеживаемых ключей и период очистки просроченных
+LOGIN_THROTTLE_ATTEMPTS = int(os.environ.get("ITSM_LOGIN_THROTTLE_ATTEMPTS", "5"))
+LOGIN_THROTTLE_IP_ATTEMPTS = int(os.environ.get("ITSM_LOGIN_THROTTLE_IP_ATTEMPTS", "50"))
+LOGIN_THROTTLE_WINDOW = float(os.environ.get("ITSM_LOGIN_THROTTLE_WINDOW", "60"))
+LOGIN_THROTTLE_MAX_KEYS = int(os.environ.get("ITSM_LOGIN_THROTTLE_MAX_KEYS", "100000"))
+LOGIN_THROTTLE_SWEEP_INTERVAL = float(os.environ.get("ITSM_LOGIN_THROTTLE_SWEEP_INTERVAL", "30"))
+
+# Сессии на стороне сервера: хранилище (sqlite или memory), имя cookie, срок жизни в секундах,
+# флаг Secure для cookie, максимум сессий в памяти и период удаления истекших сессий
+SESSION_BACKEND = os.environ.get("ITSM_SESSION_BACKEND", "sqlite")
+SESSION_COOKIE = os.environ.get("ITSM_SESSION_COOKIE", "session")
+SESSION_MAX_AGE = int(os.environ.get("ITSM_SESSION_MAX_AGE", str(14 * 24 * 60 * 60)))
+SESSION_HTTPS_ONLY = os.environ.get("ITSM_SESSION_HTTPS_ONLY", "0") == "1"
+SESSION_MEMORY_MAX_SESSIONS = int(os.environ.get("ITSM_SESSION_MEMORY_MAX_SESSIONS", "100000"))
+SESSION_PURGE_INTERVAL = float(os.environ.get("ITSM_SESSION_PURGE_INTERVAL", "3600"))
+
+# Push-канал чата (Server-Sent Events): длина очереди событий одного подключения
+# (при переполнении подключение закрывается) и интервал keepalive/проверки пропущенных сообщений, в секундах
+CHAT_STREAM_QUEUE_SIZE = int(os.environ.get("ITSM_CHAT_STREAM_QUEUE_SIZE", "100"))
+CHAT_STREAM_KEEPALIVE = float(os.environ.get("ITSM_CHAT_STREAM_KEEPALIVE", "15"))
+
+# История чата: сообщений на странице (последняя страница при открытии и «загрузить ранее»)
+# и максимальный размер страницы, который можно запросить
+CHAT_PAGE_SIZE = int(os.environ.get("ITSM_CHAT_PAGE_SIZE", "50"))
+CHAT_PAGE_MAX = int(os.environ.get("ITSM_CHAT_PAGE_MAX", "200"))
+
+# Очередь инцидентов для поддержки: инцидентов на странице и максимальный размер страницы
+INCIDENT_PAGE_SIZE = int(os.environ.get("ITSM_INCIDENT_PAGE_SIZE", "50"))
+INCIDENT_PAGE_MAX = int(os.environ.get("ITSM_INCIDENT_PAGE_MAX", "200"))
+
+# Аналитика времени решения: инцидентов в одной пачке пересчета и число недель в отчете
+ANALYTICS_BATCH_SIZE = int(os.environ.get("ITSM_ANALYTICS_BATCH_SIZE", "20000"))
+ANALYTICS_WEEKS = int(os.environ.get("ITSM_ANALYTICS_WEEKS", "12"))
+
+# Число недавних переписок на странице контактов
+CONTACTS_RECENT_LIMIT = int(os.environ.get("ITSM_CONTACTS_RECENT_LIMIT", "20"))
+
+# Поиск пользователей на странице контактов: результатов по умолчанию и максимум на страницу
+CONTACTS_SEARCH_LIMIT = int(os.environ.get("ITSM_CONTACTS_SEARCH_LIMIT", "20"))
+CONTACTS_SEARCH_MAX = int(os.environ.get("ITSM_CONTACTS_SEARCH_MAX", "50"))
+
+# Индекс блокировок в памяти: число пользователей в кэше и время жизни записи в секундах
+# (ограничивает задержку, с которой видны блокировки, сделанные в другом процессе)
+BLOCK_INDEX_SIZE = int(os.environ.get("ITSM_BLOCK_INDEX_SIZE", "10000"))
+BLOCK_INDEX_TTL = float(os.environ.get("ITSM_BLOCK_INDEX_TTL", "30"))
+
+# Групповая запись сообщений: сколько секунд копить вставки от параллельных запросов
+# и максимальный размер пачки (пачка записывается одной транзакцией)
+MESSAGE_BATCH_WINDOW = float(os.environ.get("ITSM_MESSAGE_BATCH_WINDOW", "0.005"))
+MESSAGE_BATCH_SIZE = int(os.environ.get("ITSM_MESSAGE_BATCH_SIZE", "64"))
+
+# Поиск по сообщениям: результатов на странице по умолчанию и максимум; ранжируются только последние
+# MESSAGE_SEARCH_CANDIDATES совпадений в переписках пользователя. Если совпадений больше,
+# ответ поиска содержит truncated: true и более старые совпадения не выдаются — запрос нужно уточнить
+MESSAGE_SEARCH_PAGE_SIZE = int(os.environ.get("ITSM_MESSAGE_SEARCH_PAGE_SIZE", "20"))
+MESSAGE_SEARCH_PAGE_MAX = int(os.environ.get("ITSM_MESSAGE_SEARCH_PAGE_MAX", "100"))
+MESSAGE_SEARCH_CANDIDATES = int(os.environ.get("ITSM_MESSAGE_SEARCH_CANDIDATES", "500"))
+
+# Поиск по инцидентам: результатов на странице по умолчанию и максимум; ранжируются только последние
+# INCIDENT_SEARCH_CANDIDATES совпадений (для автора — среди его инцидентов). Если совпадений больше,
+# ответ поиска содержит truncated: true и более старые совпадения не выдаются — запрос нужно уточнить
+INCIDENT_SEARCH_PAGE_SIZE = int(os.environ.get("ITSM_INCIDENT_SEARCH_PAGE_SIZE", "20"))
+INCIDENT_SEARCH_PAGE_MAX = int(os.environ.get("ITSM_INCIDENT_SEARCH_PAGE_MAX", "100"))
+INCIDENT_SEARCH_CANDIDATES = int(os.environ.get("ITSM_INCIDENT_SEARCH_CANDIDATES", "500"))
+
+# Лента изменений инцидентов: событий в ответе по умолчанию и максимум
+INCIDENT_CHANGES_PAGE_SIZE = int(os.environ.get("ITSM_INCIDENT_CHANGES_PAGE_SIZE", "200"))
+INCIDENT_CHANGES_PAGE_MAX = int(os.environ.get("ITSM_INCIDENT_CHANGES_PAGE_MAX", "1000"))
+
+# Живая доска инцидентов (Server-Sent Events): длина очереди событий одного подключения
+# (при переполнении подключение закрывается) и интервал keepalive/проверки пропущенных событий, в секундах
+INCIDENT_STREAM_QUEUE_SIZE = int(os.environ.get("ITSM_INCIDENT_STREAM_QUEUE_SIZE", "100"))
+INCIDENT_STREAM_KEEPALIVE = float(os.environ.get("ITSM_INCIDENT_STREAM_KEEPALIVE", "15"))
+
+# Хранение сообщений: сообщения старше MESSAGE_RETENTION_DAYS дней (0 — не архивировать) переносятся
+# в messages_archive пачками по MESSAGE_RETENTION_BATCH_SIZE с паузой между пачками, раз в MESSAGE_RETENTION_INTERVAL секунд
+MESSAGE_RETENTION_DAYS = int(os.environ.get("ITSM_MESSAGE_RETENTION_DAYS", "0"))
+MESSAGE_RETENTION_BATCH_SIZE = int(os.environ.get("ITSM_MESSAGE_RETENTION_BATCH_SIZE", "500"))
+MESSAGE_RETENTION_INTERVAL = float(os.environ.get("ITSM_MESSAGE_RETENTION_INTERVAL", "3600"))
+MESSAGE_RETENTION_PAUSE = float(os.environ.get("ITSM_MESSAGE_RETENTION_PAUSE", "0.05"))
+
+# Удаление переписки: сообщений в одной транзакции
+MESSAGE_DELETE_BATCH_SIZE = int(os.environ.get("ITSM_MESSAGE_DELETE_BATCH_SIZE", "500"))
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import logging
+
+import aiosqlite
+
+from app.config import DATABASE
+
+logger = logging.getLogger(__name__)
+
+# Сводка переписки хранится в conversations, по строке на пару пользователей (user1_id < user2_id):
+# последнее сообщение, его время и число непрочитанных у каждой стороны
+
+
+def pair(user_a: int, user_b: int) -> tuple:
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+# Обновляет сводки после вставки сообщений; вызывается в той же транзакции, что и INSERT в messages.
+# messages — [(id, sender_id, receiver_id, timestamp)] по возрастанию id; пары агрегируются в одну строку
+async def record_messages(db: aiosqlite.Connection, messages):
+    summaries = {}
+    for message_id, sender_id, receiver_id, timestamp in messages:
+        user1_id, user2_id = pair(sender_id, receiver_id)
+        summary = summaries.setdefault((user1_id, user2_id), [0, None, 0, 0])
+        summary[0], summary[1] = message_id, timestamp
+        # Непрочитанное увеличивается у получателя
+        summary[2 if receiver_id == user1_id else 3] += 1
+    await db.executemany("""
+        INSERT INTO conversations (user1_id, user2_id, last_message_id, last_timestamp, user1_unread, user2_unread)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user1_id, user2_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_timestamp = excluded.last_timestamp,
+            user1_unread = user1_unread + excluded.user1_unread,
+            user2_unread = user2_unread + excluded.user2_unread
+    """, [key + tuple(summary) for key, summary in summaries.items()])
+
+
+# Отмечает сообщения собеседника прочитанными и обнуляет счетчик непрочитанных пользователя
+async def mark_read(db: aiosqlite.Connection, user_id: int, other_user_id: int):
+    user1_id, user2_id = pair(user_id, other_user_id)
+    column = "user1_unread" if user_id == user1_id else "user2_unread"
+    await db.execute(f"UPDATE conversations SET {column} = 0 WHERE user1_id = ? AND user2_id = ?", (user1_id, user2_id))
+    await db.execute("""
+        UPDATE messages SET is_read = 1
+        WHERE sender_id = ? AND receiver_id = ? AND is_read = 0
+    """, (other_user_id, user_id))
+
+
+# Удаляет сводку вместе с перепиской
+async def delete_summary(db: aiosqlite.Connection, user_a: int, user_b: int):
+    await db.execute("DELETE FROM conversations WHERE user1_id = ? AND user2_id = ?", pair(user_a, user_b))
+
+
+# Число непрочитанных сообщений пользователя в переписке (по сводке)
+async def unread_count(db: aiosqlite.Connection, user_id: int, other_user_id: int) -> int:
+    user1_id, user2_id = pair(user_id, other_user_id)
+    column = "user1_unread" if user_id == user1_id else "user2_unread"
+    async with db.execute(
+        f"SELECT {column} FROM conversations WHERE user1_id = ? AND user2_id = ?", (user1_id, user2_id)
+    ) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+# Недавние переписки пользователя: (id собеседника, имя, время последнего сообщения, непрочитанных).
+# Каждая половина читается по индексу (user1_id/user2_id, last_timestamp)
+async def recent_conversations(db: aiosqlite.Connection, user_id: int, limit: int):
+    async with db.execute("""
+        SELECT c.other_id, u.username, c.last_timestamp, c.unread
+        FROM (
+            SELECT * FROM (
+                SELECT user2_id AS other_id, last_timestamp, user1_unread AS unread
+                FROM conversations WHERE user1_id = ? AND last_message_id IS NOT NULL
+                ORDER BY last_timestamp DESC LIMIT ?
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT user1_id AS other_id, last_timestamp, user2_unread AS unread
+                FROM conversations WHERE user2_id = ? AND last_message_id IS NOT NULL
+                ORDER BY last_timestamp DESC LIMIT ?
+            )
+        ) c
+        JOIN users u ON u.id = c.other_id
+        ORDER BY c.last_timestamp DESC
+        LIMIT ?
+    """, (user_id, limit, user_id, limit, limit)) as cursor:
+        return await cursor.fetchall()
+
+
+# Пересчитывает сводки всех переписок по таблице messages (идемпотентно)
+async def backfill(db: aiosqlite.Connection) -> int:
+    await db.execute("""
+        INSERT INTO conversations (user1_id, user2_id, last_message_id, last_timestamp, user1_unread, user2_unread)
+        SELECT
+            MIN(sender_id, receiver_id) AS u1,
+            MAX(sender_id, receiver_id) AS u2,
+            MAX(id),
+            -- «голый» столбец берется из строки с MAX(id) (единственный агрегат min/max в запросе)
+            timestamp,
+            SUM(is_read = 0 AND receiver_id = MIN(sender_id, receiver_id)),
+            SUM(is_read = 0 AND receiver_id = MAX(sender_id, receiver_id))
+        FROM messages
+        WHERE sender_id != receiver_id
+        GROUP BY u1, u2
+        ON CONFLICT(user1_id, user2_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_timestamp = excluded.last_timestamp,
+            user1_unread = excluded.user1_unread,
+            user2_unread = excluded.user2_unread
+    """)
+    # Переписки, сообщения которых удалены
+    await db.execute("""
+        UPDATE conversations
+        SET last_message_id = NULL, last_timestamp = NULL, user1_unread = 0, user2_unread = 0
+        WHERE last_message_id IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM messages m
+            WHERE (m.sender_id = conversations.user1_id AND m.receiver_id = conversations.user2_id)
+               OR (m.sender_id = conversations.user2_id AND m.receiver_id = conversations.user1_id)
+        )
+    """)
+    async with db.execute("SELECT COUNT(*) FROM conversations WHERE last_message_id IS NOT NULL") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def run_backfill(database: str = DATABASE) -> int:
+    async with aiosqlite.connect(database, isolation_level=None) as db:
+        await db.execute("PRAGMA busy_timeout = 5000")
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            count = await backfill(db)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Пересчет сводок переписок (таблица conversations) по истории сообщений")
+    parser.add_argument("--database", default=DATABASE, help="Путь к файлу базы данных")
+    args = parser.parse_args()
+    count = asyncio.run(run_backfill(args.database))
+    print(f"Переписок со сводкой: {count}")
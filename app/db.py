@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from app.config import (
+    DATABASE, DB_POOL_SIZE, DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_CACHE_SIZE, DB_MMAP_SIZE, DB_BUSY_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Общие PRAGMA для всех соединений приложения
+async def configure_connection(db: aiosqlite.Connection, read_only: bool = False):
+    await db.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    await db.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    await db.execute(f"PRAGMA cache_size = {DB_CACHE_SIZE}")
+    await db.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    await db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}")
+    if read_only:
+        # Читатели не могут писать: все изменения идут через writer
+        await db.execute("PRAGMA query_only = ON")
+
+
+# Пул постоянных соединений с SQLite для чтения, общий для всех маршрутов
+class ConnectionPool:
+    def __init__(self, database: str, size: int):
+        self.database = database
+        self.size = size
+        self._idle = None
+        self._connections = []
+        self._users = 0
+        self._lock = asyncio.Lock()
+        # Статистика пула
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.in_use = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._idle is not None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.database)
+        await configure_connection(db, read_only=True)
+        return db
+
+    # Открывает пул; повторные вызовы (например, из lifespan app и app1) только увеличивают счетчик владельцев.
+    # Ленивое открытие (owner=False) владельца не добавляет: пул закроет первый же вызов close()
+    async def open(self, owner: bool = True):
+        async with self._lock:
+            if owner:
+                self._users += 1
+            if self.is_open:
+                return
+            idle = asyncio.Queue()
+            for _ in range(self.size):
+                db = await self._connect()
+                self._connections.append(db)
+                idle.put_nowait(db)
+            self._idle = idle
+            logger.info(f"Пул соединений открыт: {self.database}, соединений: {self.size}")
+
+    async def close(self):
+        async with self._lock:
+            self._users = max(self._users - 1, 0)
+            if self._users or not self.is_open:
+                return
+            for db in self._connections:
+                await db.close()
+            self._connections = []
+            self._idle = None
+            logger.info("Пул соединений закрыт")
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self.is_open:
+            # Пул используется вне lifespan (скрипты, тесты) — открываем лениво
+            await self.open(owner=False)
+        started = time.perf_counter()
+        db = await self._idle.get()
+        waited = time.perf_counter() - started
+        self.checkouts += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        self.in_use += 1
+        try:
+            yield db
+        finally:
+            self.in_use -= 1
+            await self._release(db)
+
+    async def _release(self, db: aiosqlite.Connection):
+        # Соединение возвращается в пул в исходном состоянии
+        try:
+            if db.in_transaction:
+                await db.rollback()
+            db.row_factory = None
+        except Exception as e:
+            logger.error(f"Ошибка при возврате соединения в пул: {e}")
+        if self._idle is not None:
+            self._idle.put_nowait(db)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "checkouts": self.checkouts,
+            "wait_time_total": round(self.wait_time, 6),
+            "wait_time_avg": round(self.wait_time / self.checkouts, 6) if self.checkouts else 0.0,
+            "wait_time_max": round(self.max_wait_time, 6),
+        }
+
+
+# Единственное пишущее соединение: задания на запись выполняются по очереди,
+# каждое в своей транзакции BEGIN IMMEDIATE
+class Writer:
+    def __init__(self, database: str):
+        self.database = database
+        self._db = None
+        self._queue = None
+        self._task = None
+        self._users = 0
+        self._lock = asyncio.Lock()
+        # Статистика записи
+        self.jobs = 0
+        self.failures = 0
+        self.busy_time = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self._task is not None
+
+    async def open(self, owner: bool = True):
+        async with self._lock:
+            if owner:
+                self._users += 1
+            if self.is_open:
+                return
+            self._db = await aiosqlite.connect(self.database, isolation_level=None)
+            await configure_connection(self._db)
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Writer запущен: {self.database}")
+
+    async def close(self):
+        async with self._lock:
+            self._users = max(self._users - 1, 0)
+            if self._users or not self.is_open:
+                return
+            # Дожидаемся выполнения уже поставленных в очередь заданий
+            await self._queue.put(None)
+            await self._task
+            await self._db.close()
+            self._db = None
+            self._queue = None
+            self._task = None
+            logger.info("Writer остановлен")
+
+    # Ставит задание job(db, *args) в очередь и ждет результата его транзакции
+    async def submit(self, job, *args):
+        if not self.is_open:
+            await self.open(owner=False)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((job, args, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+            job, args, future = item
+            started = time.perf_counter()
+            try:
+                await self._db.execute("BEGIN IMMEDIATE")
+                result = await job(self._db, *args)
+                await self._db.commit()
+            except BaseException as e:
+                self.failures += 1
+                try:
+                    if self._db.in_transaction:
+                        await self._db.rollback()
+                except Exception as rollback_error:
+                    logger.error(f"Ошибка при откате транзакции: {rollback_error}")
+                if not future.done():
+                    future.set_exception(e)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.jobs += 1
+                self.busy_time += time.perf_counter() - started
+
+    def stats(self) -> dict:
+        return {
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "busy_time_total": round(self.busy_time, 6),
+        }
+
+
+pool = ConnectionPool(DATABASE, DB_POOL_SIZE)
+writer = Writer(DATABASE)
+
+
+# Зависимость FastAPI: выдает соединение для чтения из пула на время запроса
+async def get_db():
+    async with pool.acquire() as db:
+        yield db
+
+
+# Выполняет job(db, *args) в транзакции на пишущем соединении
+async def write(job, *args):
+    return await writer.submit(job, *args)
+
+
+async def _execute(db: aiosqlite.Connection, sql: str, params):
+    cursor = await db.execute(sql, params)
+    return cursor.lastrowid
+
+
+# Выполняет одиночный запрос на запись; возвращает lastrowid
+async def write_execute(sql: str, params=()):
+    return await writer.submit(_execute, sql, params)
+
+
+# Вызываются из lifespan приложений
+async def startup():
+    await writer.open()
+    await pool.open()
+
+
+async def shutdown():
+    await pool.close()
+    await writer.close()
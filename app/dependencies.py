@@ -1,16 +1,41 @@
 import aiosqlite
 from fastapi import Request, HTTPException, status, Depends
-from app.config import DATABASE
+from app.cache import TTLCache
+from app.config import USER_CACHE_SIZE, USER_CACHE_TTL
+from app.db import pool
 
+# Кэш (id, username, role) по user_id из сессии; сбрасывается при изменении пользователя администратором
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+async def load_user(db: aiosqlite.Connection, user_id: int):
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    return await _select_user(db, user_id)
+
+# Читает пользователя из базы и кладет в кэш
+async def _select_user(db: aiosqlite.Connection, user_id: int):
+    async with db.execute("SELECT id, username, role FROM users WHERE id = ?", (user_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    user = {"id": row[0], "username": row[1], "role": row[2]}
+    user_cache.set(user_id, user)
+    return user
+
+# Соединение из пула берется только при промахе кэша и сразу возвращается: зависимость get_db
+# держала бы его до конца обработчика, в том числе пока тот ждет writer или групповую запись
 async def get_current_user(request: Request):
     user_id = request.session.get('user_id')
     if user_id:
         try:
-            async with aiosqlite.connect(DATABASE) as db:
-                async with db.execute("SELECT id, username, role FROM users WHERE id = ?", (user_id,)) as cursor:
-                    user = await cursor.fetchone()
-                    if user:
-                        return {"id": user[0], "username": user[1], "role": user[2]}
+            user = user_cache.get(user_id)
+            if user is None:
+                async with pool.acquire() as db:
+                    user = await _select_user(db, user_id)
+            if user:
+                # Копия, чтобы обработчики не могли изменить запись в кэше
+                return dict(user)
         except Exception as e:
             # Логирование ошибки
             print(f"Ошибка при получении текущего пользователя: {e}")
@@ -1,92 +1,471 @@
+import asyncio
 import json
 import os
-from fastapi import APIRouter, Request, Depends, Form, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse
+from datetime import date
+from typing import List
+from urllib.parse import urlencode
+from fastapi import APIRouter, Request, Depends, Form, HTTPException, Query, status
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 import aiosqlite
 from app.dependencies import get_current_user
-from app.config import BASE_DIR, DATABASE
+from app.config import (
+    BASE_DIR, INCIDENT_PAGE_SIZE, INCIDENT_PAGE_MAX, INCIDENT_SEARCH_PAGE_SIZE, INCIDENT_SEARCH_PAGE_MAX,
+    INCIDENT_SEARCH_CANDIDATES, INCIDENT_CHANGES_PAGE_SIZE, INCIDENT_CHANGES_PAGE_MAX, INCIDENT_STREAM_KEEPALIVE,
+)
+from app.db import get_db, pool, write
+from app.broker import incident_broker, INCIDENTS_TOPIC
+from app.cart import merge_items, price_cart, insert_service_request
+from app.incident_counters import INCIDENT_STATUSES, count_created, count_transition, incident_counts
+from app.incident_events import record_created, record_update, last_event_id, incident_changes
+from app.search import fts_query, snippet_html, marked_scores, SNIPPET_START, SNIPPET_END
 
 router = APIRouter()
 router1 = APIRouter()
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "app", "templates"))
 templates2 = Jinja2Templates(directory=os.path.join(BASE_DIR, "app", "templates2"))
 
-@router.get("/incidents/my", response_class=HTMLResponse)
-async def my_combined_requests(request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        db.row_factory = aiosqlite.Row
-        # Получаем инциденты пользователя
-        async with db.execute("""
-            SELECT id AS incident_id, title, status, created_at
-            FROM incidents
-            WHERE reporter_id = ?
-        """, (current_user['id'],)) as cursor:
-            incidents = [dict(row) for row in await cursor.fetchall()]  # Преобразуем Row в словари
-
-        # Для каждого инцидента получаем связанные услуги
-        for incident in incidents:
-            async with db.execute("""
-                SELECT s.name, sci.quantity
-                FROM service_cart_items sci
-                JOIN services s ON sci.service_id = s.id
-                WHERE sci.request_id = (
-                    SELECT id FROM service_requests WHERE user_id = ? AND request_date = ?
-                )
-            """, (current_user['id'], incident['created_at'])) as cursor:
-                incident['services'] = [dict(row) for row in await cursor.fetchall()]  # Преобразуем Row в словари
+# Веса колонок incidents_fts (тема, описание) при ранжировании результатов поиска
+INCIDENT_SEARCH_WEIGHTS = (4.0, 1.0)
+# Последнее слово запроса ищется по префиксу, начиная с длины самого короткого префиксного индекса incidents_fts
+INCIDENT_SEARCH_MIN_PREFIX = 2
+
+# Создает инцидент и связанную заявку на услуги (выполняется на пишущем соединении).
+# services — {service_id: количество}. Возвращает события журнала для рассылки
+async def _create_combined_request(db: aiosqlite.Connection, user_id: int, title: str, description: str, services: dict):
+    # Проверяем и добавляем выбранные услуги
+    service_request_id = None
+    if services:
+        # Все услуги проверяются одним запросом: допускаются только бизнес-услуги
+        lines, total_price, missing = await price_cart(db, services, category='business')
+        if missing:
+            raise HTTPException(status_code=400, detail="Некорректная услуга.")
+        # Создаем заявку на услуги вместе с позициями
+        service_request_id = await insert_service_request(db, user_id, lines, total_price)
+
+    # Создаем инцидент со ссылкой на заявку
+    cursor = await db.execute("""
+        INSERT INTO incidents (title, description, status, created_at, updated_at, reporter_id, service_request_id, status_path)
+        VALUES (?, ?, 'open', datetime('now'), datetime('now'), ?, ?, 'open')
+    """, (title, description, user_id, service_request_id))
+    await count_created(db, 'open')
+    return await record_created(db, cursor.lastrowid, 'open')
+
+# Инциденты пользователя (новые первыми) вместе с услугами связанных заявок — одним запросом
+# по индексам idx_incidents_reporter и idx_service_cart_items_request
+async def _my_incidents(db: aiosqlite.Connection, user_id: int) -> list:
+    async with db.execute("""
+        SELECT i.id, i.title, i.status, i.created_at, s.name, sci.quantity
+        FROM incidents i
+        LEFT JOIN service_cart_items sci ON sci.request_id = i.service_request_id
+        LEFT JOIN services s ON s.id = sci.service_id
+        WHERE i.reporter_id = ?
+        ORDER BY i.id DESC, sci.id
+    """, (user_id,)) as cursor:
+        rows = await cursor.fetchall()
+    incidents = {}
+    for incident_id, title, status, created_at, name, quantity in rows:
+        incident = incidents.get(incident_id)
+        if incident is None:
+            incident = incidents[incident_id] = {
+                "incident_id": incident_id, "title": title, "status": status, "created_at": created_at, "services": []
+            }
+        if name is not None:
+            incident["services"].append({"name": name, "quantity": quantity})
+    return list(incidents.values())
+
+# Страница очереди инцидентов, новые первыми: строго раньше курсора before = (created_at, id).
+# Каждый статус читается отдельным подзапросом по индексу (status | assignee_id, status | reporter_id, status;
+# created_at), результаты сливаются. filters — statuses, assignee_id, reporter_id, created_from, created_to.
+# Возвращает (инциденты, есть ли еще)
+async def _incident_queue(db: aiosqlite.Connection, filters: dict, limit: int, before=None):
+    conditions, params = [], []
+    if filters.get("assignee_id") is not None:
+        conditions.append("AND i.assignee_id = ?")
+        params.append(filters["assignee_id"])
+    if filters.get("reporter_id") is not None:
+        conditions.append("AND i.reporter_id = ?")
+        params.append(filters["reporter_id"])
+    if filters.get("created_from") is not None:
+        conditions.append("AND i.created_at >= ?")
+        params.append(str(filters["created_from"]))
+    if filters.get("created_to") is not None:
+        # Дата «по» включительно
+        conditions.append("AND i.created_at < date(?, '+1 day')")
+        params.append(str(filters["created_to"]))
+    if before is not None:
+        conditions.append("AND (i.created_at, i.id) < (?, ?)")
+        params.extend(before)
+    condition = " ".join(conditions)
+    subqueries, query_params = [], []
+    for incident_status in filters["statuses"]:
+        subqueries.append(f"""
+            SELECT * FROM (
+                SELECT i.id, i.title, i.status, i.created_at, i.reporter_id, i.assignee_id FROM incidents i
+                WHERE i.status = ? {condition}
+                ORDER BY i.created_at DESC, i.id DESC LIMIT ?
+            )
+        """)
+        query_params.extend([incident_status, *params, limit + 1])
+    async with db.execute(f"""
+        SELECT q.id, q.title, q.status, q.created_at, q.reporter_id, r.username, q.assignee_id, a.username
+        FROM ({" UNION ALL ".join(subqueries)}) q
+        JOIN users r ON r.id = q.reporter_id
+        LEFT JOIN users a ON a.id = q.assignee_id
+        ORDER BY q.created_at DESC, q.id DESC
+        LIMIT ?
+    """, (*query_params, limit + 1)) as cursor:
+        rows = await cursor.fetchall()
+    incidents = [{
+        "incident_id": row[0],
+        "title": row[1],
+        "status": row[2],
+        "created_at": row[3],
+        "reporter_id": row[4],
+        "reporter_username": row[5],
+        "assignee_id": row[6],
+        "assignee_username": row[7],
+    } for row in rows[:limit]]
+    return incidents, len(rows) > limit
+
+# Разбирает фильтры очереди; автора можно указать по id или по имени
+async def _queue_filters(db: aiosqlite.Connection, statuses, assignee_id, reporter_id, reporter, created_from, created_to) -> dict:
+    statuses = list(dict.fromkeys(statuses or INCIDENT_STATUSES))
+    if any(incident_status not in INCIDENT_STATUSES for incident_status in statuses):
+        raise HTTPException(status_code=400, detail="Некорректный статус.")
+    if reporter_id is None and reporter:
+        async with db.execute("SELECT id FROM users WHERE username = ?", (reporter,)) as cursor:
+            row = await cursor.fetchone()
+        # Несуществующий автор — пустой результат
+        reporter_id = row[0] if row else 0
+    return {
+        "statuses": statuses,
+        "assignee_id": assignee_id,
+        "reporter_id": reporter_id,
+        "created_from": created_from,
+        "created_to": created_to,
+    }
+
+# Курсор следующей страницы очереди: (created_at, id) последнего инцидента страницы
+def _queue_cursor(incidents, has_more: bool):
+    if not has_more or not incidents:
+        return None
+    return {"created_at": incidents[-1]["created_at"], "id": incidents[-1]["incident_id"]}
+
+# Кандидаты поиска: последние INCIDENT_SEARCH_CANDIDATES совпадений (для автора — среди его инцидентов)
+# с выделением совпадений в обеих колонках; лишняя строка показывает, что совпадений больше.
+# bm25() здесь не используется: для подсчета IDF FTS5 читает весь список документов каждого слова,
+# и частые слова стоили бы десятки миллисекунд на запрос
+async def _search_candidates(db: aiosqlite.Connection, match: str, reporter_id: int = None):
+    if reporter_id is None:
+        query = """
+            SELECT incidents_fts.rowid, highlight(incidents_fts, 0, ?, ?), highlight(incidents_fts, 1, ?, ?)
+            FROM incidents_fts
+            WHERE incidents_fts MATCH ?
+            ORDER BY incidents_fts.rowid DESC
+            LIMIT ?
+        """
+        params = (match, INCIDENT_SEARCH_CANDIDATES + 1)
+    else:
+        # Инциденты автора берутся по индексу, а MATCH проверяется для каждого из них по rowid
+        query = """
+            SELECT i.id, highlight(incidents_fts, 0, ?, ?), highlight(incidents_fts, 1, ?, ?)
+            FROM incidents i
+            CROSS JOIN incidents_fts ON incidents_fts.rowid = i.id
+            WHERE i.reporter_id = ? AND incidents_fts MATCH ?
+            ORDER BY i.id DESC
+            LIMIT ?
+        """
+        params = (reporter_id, match, INCIDENT_SEARCH_CANDIDATES + 1)
+    async with db.execute(query, (SNIPPET_START, SNIPPET_END, SNIPPET_START, SNIPPET_END, *params)) as cursor:
+        return await cursor.fetchall()
+
+# Поиск по теме и описанию инцидентов (FTS5), по релевантности. reporter_id ограничивает поиск
+# инцидентами автора. Кандидаты ранжируются (совпадение в теме весит больше, чем в описании), данные инцидента
+# и фрагмент описания дочитываются только для limit строк страницы. Возвращает (строки, truncated):
+# строка — (id, тема, статус, дата создания, автор, тема и фрагмент описания с маркерами выделения);
+# truncated — совпадений больше INCIDENT_SEARCH_CANDIDATES и более старые не ранжировались
+async def _search_incidents(db: aiosqlite.Connection, match: str, limit: int, offset: int, reporter_id: int = None):
+    candidates = await _search_candidates(db, match, reporter_id)
+    truncated = len(candidates) > INCIDENT_SEARCH_CANDIDATES
+    candidates = candidates[:INCIDENT_SEARCH_CANDIDATES]
+    scores = marked_scores([candidate[1:] for candidate in candidates], INCIDENT_SEARCH_WEIGHTS)
+    ranked = sorted(zip(scores, candidates), key=lambda item: (-item[0], -item[1][0]))[offset:offset + limit]
+    if not ranked:
+        return [], truncated
+    titles = {candidate[0]: candidate[1] for _, candidate in ranked}
+    async with db.execute("""
+        SELECT i.id, i.title, i.status, i.created_at, u.username, snippet(incidents_fts, 1, ?, ?, '…', 24)
+        FROM incidents_fts
+        JOIN incidents i ON i.id = incidents_fts.rowid
+        JOIN users u ON u.id = i.reporter_id
+        WHERE incidents_fts MATCH ? AND incidents_fts.rowid IN (SELECT value FROM json_each(?))
+    """, (SNIPPET_START, SNIPPET_END, match, json.dumps(list(titles)))) as cursor:
+        rows = {row[0]: row for row in await cursor.fetchall()}
+    return [(*rows[incident_id][:5], title, rows[incident_id][5]) for incident_id, title in titles.items() if incident_id in rows], truncated
+
+# Ответ поиска по инцидентам с тем же правилом доступа, что у incident_detail:
+# сотрудники ищут по всем инцидентам, остальные — только по своим. Страницы идут в пределах ранжированных
+# кандидатов; truncated сообщает, что более старые совпадения в результаты не попали (нужен более точный запрос)
+async def _incident_search_response(db: aiosqlite.Connection, current_user: dict, q: str, page: int, page_size: int):
+    page = max(page, 1)
+    page_size = max(1, min(page_size, INCIDENT_SEARCH_PAGE_MAX))
+    reporter_id = None if current_user['role'] in ['employee', 'admin'] else current_user['id']
+    match = fts_query(q, INCIDENT_SEARCH_MIN_PREFIX)
+    rows, truncated = [], False
+    if match is not None:
+        rows, truncated = await _search_incidents(db, match, page_size + 1, (page - 1) * page_size, reporter_id)
+    return JSONResponse(content={
+        "results": [{
+            "incident_id": row[0],
+            "title": row[1],
+            "status": row[2],
+            "created_at": row[3],
+            "reporter_username": row[4],
+            "title_html": snippet_html(row[5]),
+            "snippet": snippet_html(row[6])
+        } for row in rows[:page_size]],
+        "page": page,
+        "has_more": len(rows) > page_size,
+        "truncated": truncated
+    })
+
+def _require_staff(current_user: dict):
+    if current_user['role'] not in ['employee', 'admin']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Доступ запрещен")
+
+# Обновляет статус инцидента (выполняется на пишущем соединении). Возвращает события журнала для рассылки
+async def _update_incident(db: aiosqlite.Connection, incident_id: int, status: str, assignee_id: int):
+    async with db.execute("SELECT status, assignee_id FROM incidents WHERE id = ?", (incident_id,)) as cursor:
+        previous = await cursor.fetchone()
+    if previous is None:
+        return []
+    # Одним UPDATE: статус, исполнитель, путь статусов и, при закрытии, время решения в минутах
+    await db.execute("""
+        UPDATE incidents SET
+            status = ?,
+            updated_at = datetime('now'),
+            assignee_id = ?,
+            status_path = CASE WHEN status = ? THEN status_path ELSE COALESCE(status_path, '?') || '>' || ? END,
+            resolution_time = CASE WHEN ? = 'closed'
+                THEN CAST((julianday('now') - julianday(created_at)) * 24 * 60 AS INTEGER)
+                ELSE resolution_time END
+        WHERE id = ?
+    """, (status, assignee_id, status, status, status, incident_id))
+    # Счетчики и журнал изменений меняются в той же транзакции, что и статус
+    await count_transition(db, previous[0], previous[1], status, assignee_id)
+    return await record_update(db, incident_id, previous[0], previous[1], status, assignee_id)
+
+# Рассылает подписчикам живой доски события уже зафиксированной транзакции
+def _publish_incident_events(events: list):
+    for event in events:
+        incident_broker.publish(INCIDENTS_TOPIC, event)
+
+def _sse_incident_event(event: dict) -> str:
+    return f"id: {event['id']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+# События живой доски после события after. Подписка оформляется до дочитывания из журнала, чтобы не потерять
+# изменения, зафиксированные в промежутке. Рассылка идет после фиксации, и параллельные изменения могут прийти
+# не по порядку; id событий идут подряд, поэтому пропуск в нумерации — повод дочитать журнал.
+# Если отставание больше страницы журнала, клиенту отправляется reload — дешевле перечитать доску целиком
+async def _incident_board_events(after: int):
+    with incident_broker.subscribe(INCIDENTS_TOPIC) as subscription:
+        catch_up = True
+        while True:
+            if catch_up:
+                async with pool.acquire() as db:
+                    missed, has_more = await incident_changes(db, after, INCIDENT_CHANGES_PAGE_MAX)
+                if has_more:
+                    yield "event: reload\ndata: {}\n\n"
+                    return
+                for event in missed:
+                    after = event["id"]
+                    yield _sse_incident_event(event)
+                catch_up = False
+            try:
+                event = await subscription.get(INCIDENT_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Комментарий не дает прокси закрыть простаивающее соединение; заодно дочитываются
+                # изменения, сделанные через другой процесс приложения (брокер работает внутри процесса)
+                yield ": keepalive\n\n"
+                catch_up = True
+                continue
+            if event is None:
+                # Отключены брокером за отставание: клиент переподключится с Last-Event-ID
+                return
+            if event["id"] > after + 1:
+                catch_up = True
+            elif event["id"] == after + 1:
+                after = event["id"]
+                yield _sse_incident_event(event)
 
+@router.get("/incidents/my", response_class=HTMLResponse)
+async def my_combined_requests(request: Request, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    # Инциденты пользователя вместе с услугами связанных заявок
+    incidents = await _my_incidents(db, current_user['id'])
     return templates.TemplateResponse("my_incidents.html", {"request": request, "incidents": incidents, "user": current_user})
 
 
 
 # Маршрут для просмотра списка всех инцидентов (для технической поддержки)
 @router.get("/incidents", response_class=HTMLResponse)
-async def all_incidents(request: Request, current_user: dict = Depends(get_current_user)):
-    if current_user['role'] not in ['employee', 'admin']:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Доступ запрещен")
-    async with aiosqlite.connect(DATABASE) as db:
-        db.row_factory = aiosqlite.Row  # Устанавливаем row_factory
-        async with db.execute("""
-            SELECT
-                i.id AS incident_id,
-                i.title,
-                i.status,
-                i.created_at,
-                u.username AS reporter_username
-            FROM incidents i
-            JOIN users u ON i.reporter_id = u.id
-        """) as cursor:
-            incidents = await cursor.fetchall()
-    return templates.TemplateResponse("all_incidents.html", {"request": request, "incidents": incidents, "user": current_user})
+async def all_incidents(
+    request: Request,
+    statuses: List[str] = Query(None, alias="status"),
+    assignee_id: int = None,
+    reporter_id: int = None,
+    reporter: str = None,
+    created_from: date = None,
+    created_to: date = None,
+    before_created_at: str = None,
+    before_id: int = None,
+    limit: int = INCIDENT_PAGE_SIZE,
+    current_user: dict = Depends(get_current_user),
+    db: aiosqlite.Connection = Depends(get_db)
+):
+    _require_staff(current_user)
+    filters = await _queue_filters(db, statuses, assignee_id, reporter_id, reporter, created_from, created_to)
+    limit = max(1, min(limit, INCIDENT_PAGE_MAX))
+    before = (before_created_at, before_id) if before_created_at is not None and before_id is not None else None
+    # Доска обновляется по журналу изменений начиная с отметки, прочитанной до очереди
+    last_id = await last_event_id(db)
+    incidents, has_more = await _incident_queue(db, filters, limit, before)
+    # Сотрудники для фильтра по исполнителю
+    async with db.execute("""
+        SELECT id, username FROM users WHERE role IN ('employee', 'admin') ORDER BY username
+    """) as cursor:
+        staff = await cursor.fetchall()
+    next_cursor = _queue_cursor(incidents, has_more)
+    next_url = None
+    if next_cursor:
+        query = [(key, value) for key, value in request.query_params.multi_items() if key not in ("before_created_at", "before_id")]
+        query += [("before_created_at", next_cursor["created_at"]), ("before_id", next_cursor["id"])]
+        next_url = "/incidents?" + urlencode(query)
+    return templates.TemplateResponse("all_incidents.html", {
+        "request": request,
+        "incidents": incidents,
+        "filters": filters,
+        "reporter": reporter or "",
+        "statuses": INCIDENT_STATUSES,
+        "staff": staff,
+        "next_url": next_url,
+        "last_event_id": last_id,
+        # Фильтры для обновления доски на месте; новые инциденты добавляются только на первую страницу без даты «по»
+        "board": {
+            "statuses": filters["statuses"],
+            "assignee_id": filters["assignee_id"],
+            "reporter_id": filters["reporter_id"],
+            "insert": before is None and created_to is None,
+        },
+        "user": current_user
+    })
+
+# Очередь инцидентов в JSON (те же фильтры и курсор, что у страницы /incidents)
+@router.get("/incidents/queue", response_class=JSONResponse)
+async def incident_queue(
+    statuses: List[str] = Query(None, alias="status"),
+    assignee_id: int = None,
+    reporter_id: int = None,
+    reporter: str = None,
+    created_from: date = None,
+    created_to: date = None,
+    before_created_at: str = None,
+    before_id: int = None,
+    limit: int = INCIDENT_PAGE_SIZE,
+    current_user: dict = Depends(get_current_user),
+    db: aiosqlite.Connection = Depends(get_db)
+):
+    _require_staff(current_user)
+    filters = await _queue_filters(db, statuses, assignee_id, reporter_id, reporter, created_from, created_to)
+    limit = max(1, min(limit, INCIDENT_PAGE_MAX))
+    before = (before_created_at, before_id) if before_created_at is not None and before_id is not None else None
+    # Отметка журнала читается до очереди: события после нее клиент дочитает из /incidents/changes
+    # (повтор уже учтенного изменения безвреден — дельты задают состояние, а не приращение)
+    last_id = await last_event_id(db)
+    incidents, has_more = await _incident_queue(db, filters, limit, before)
+    return JSONResponse(content={
+        "incidents": incidents,
+        "next_cursor": _queue_cursor(incidents, has_more),
+        "last_event_id": last_id
+    })
+
+# Лента изменений инцидентов для инкрементальной синхронизации: события после after по возрастанию id.
+# Без after возвращает только текущую отметку last_id
+@router.get("/incidents/changes", response_class=JSONResponse)
+async def incident_changes_feed(after: int = None, limit: int = INCIDENT_CHANGES_PAGE_SIZE, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    _require_staff(current_user)
+    if after is None:
+        return JSONResponse(content={"events": [], "last_id": await last_event_id(db), "has_more": False})
+    limit = max(1, min(limit, INCIDENT_CHANGES_PAGE_MAX))
+    events, has_more = await incident_changes(db, after, limit)
+    return JSONResponse(content={
+        "events": events,
+        "last_id": events[-1]["id"] if events else after,
+        "has_more": has_more
+    })
+
+# Push-канал живой доски инцидентов (Server-Sent Events); при переподключении браузер передает
+# id последнего события в Last-Event-ID
+@router.get("/incidents/stream")
+async def incident_stream(request: Request, after: int = 0, current_user: dict = Depends(get_current_user)):
+    _require_staff(current_user)
+    last_event_id_header = request.headers.get("last-event-id")
+    if last_event_id_header and last_event_id_header.isdigit():
+        after = int(last_event_id_header)
+    return StreamingResponse(
+        _incident_board_events(after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Поиск по инцидентам: ранжированные результаты с выделенными фрагментами (title_html и snippet — готовый HTML)
+@router.get("/incidents/search", response_class=JSONResponse)
+async def search_incidents(q: str, page: int = 1, page_size: int = INCIDENT_SEARCH_PAGE_SIZE, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    return await _incident_search_response(db, current_user, q, page, page_size)
+
+# Панель очереди: число инцидентов по статусам и исполнителям (из счетчиков incident_counters)
+@router.get("/incidents/dashboard", response_class=HTMLResponse)
+async def incident_dashboard(request: Request, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    _require_staff(current_user)
+    counts = await incident_counts(db)
+    return templates.TemplateResponse("incident_dashboard.html", {
+        "request": request,
+        "counts": counts,
+        "statuses": INCIDENT_STATUSES,
+        "user": current_user
+    })
+
+@router.get("/incidents/counters", response_class=JSONResponse)
+async def incident_counters(current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    _require_staff(current_user)
+    return JSONResponse(content=await incident_counts(db))
 
 # Маршрут для просмотра деталей инцидента
 @router.get("/incidents/{incident_id}", response_class=HTMLResponse)
-async def incident_detail(incident_id: int, request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        db.row_factory = aiosqlite.Row  # Устанавливаем row_factory
-        async with db.execute("""
-            SELECT
-                i.id AS incident_id,
-                i.title,
-                i.description,
-                i.status,
-                i.created_at,
-                i.updated_at,
-                i.reporter_id,
-                i.assignee_id,
-                i.resolution_time,
-                u.username AS reporter_username
-            FROM incidents i
-            JOIN users u ON i.reporter_id = u.id
-            WHERE i.id = ?
-        """, (incident_id,)) as cursor:
-            incident = await cursor.fetchone()
-        if not incident:
-            raise HTTPException(status_code=404, detail="Инцидент не найден")
-        # Проверка доступа
-        if current_user['role'] not in ['employee', 'admin'] and incident['reporter_id'] != current_user['id']:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Доступ запрещен")
+async def incident_detail(incident_id: int, request: Request, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    db.row_factory = aiosqlite.Row  # Устанавливаем row_factory
+    async with db.execute("""
+        SELECT
+            i.id AS incident_id,
+            i.title,
+            i.description,
+            i.status,
+            i.created_at,
+            i.updated_at,
+            i.reporter_id,
+            i.assignee_id,
+            i.resolution_time,
+            u.username AS reporter_username
+        FROM incidents i
+        JOIN users u ON i.reporter_id = u.id
+        WHERE i.id = ?
+    """, (incident_id,)) as cursor:
+        incident = await cursor.fetchone()
+    if not incident:
+        raise HTTPException(status_code=404, detail="Инцидент не найден")
+    # Проверка доступа
+    if current_user['role'] not in ['employee', 'admin'] and incident['reporter_id'] != current_user['id']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Доступ запрещен")
     return templates.TemplateResponse("incident_detail.html", {"request": request, "incident": incident, "user": current_user})
 
 
@@ -100,35 +479,19 @@ async def update_incident(
 ):
     if current_user['role'] not in ['employee', 'admin']:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Доступ запрещен")
-    async with aiosqlite.connect(DATABASE) as db:
-        # Обновляем статус инцидента
-        await db.execute("""
-            UPDATE incidents SET status = ?, updated_at = datetime('now'), assignee_id = ?
-            WHERE id = ?
-        """, (status, current_user['id'], incident_id))
-        # Если инцидент закрыт, вычисляем время решения
-        if status == 'closed':
-            async with db.execute("""
-                SELECT julianday(updated_at) - julianday(created_at) FROM incidents WHERE id = ?
-            """, (incident_id,)) as cursor:
-                time_diff = await cursor.fetchone()
-                resolution_time = int(time_diff[0] * 24 * 60)  # В минутах
-            await db.execute("""
-                UPDATE incidents SET resolution_time = ? WHERE id = ?
-            """, (resolution_time, incident_id))
-        await db.commit()
+    events = await write(_update_incident, incident_id, status, current_user['id'])
+    _publish_incident_events(events)
     return RedirectResponse(url=f"/incidents/{incident_id}", status_code=303)
 
 @router.get("/combined-request", response_class=HTMLResponse)
-async def combined_request_form(request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        # Отображаем только бизнес-услуги
-        async with db.execute("""
-            SELECT id, name, price, price_per 
-            FROM services 
-            WHERE category = 'business' AND is_active = 1
-        """) as cursor:
-            business_services = await cursor.fetchall()
+async def combined_request_form(request: Request, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    # Отображаем только бизнес-услуги
+    async with db.execute("""
+        SELECT id, name, price, price_per 
+        FROM services 
+        WHERE category = 'business' AND is_active = 1
+    """) as cursor:
+        business_services = await cursor.fetchall()
     return templates.TemplateResponse("new_combined_form.html", {"request": request, "services": business_services, "user": current_user})
 
 
@@ -143,78 +506,29 @@ async def create_combined_request(
     current_user: dict = Depends(get_current_user)
 ):
     try:
-        # Преобразуем JSON-строку в список
-        services = json.loads(selectedServices)
-    except json.JSONDecodeError:
+        # Преобразуем JSON-строку в словарь {service_id: количество}
+        services = merge_items((service["id"], service["quantity"]) for service in json.loads(selectedServices))
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
         raise HTTPException(status_code=400, detail="Некорректный формат данных для услуг.")
 
-    async with aiosqlite.connect(DATABASE) as db:
-        try:
-            # Создаем инцидент
-            await db.execute("""
-                INSERT INTO incidents (title, description, status, created_at, updated_at, reporter_id)
-                VALUES (?, ?, 'open', datetime('now'), datetime('now'), ?)
-            """, (title, description, current_user['id']))
-
-            # Получаем ID инцидента
-            async with db.execute("SELECT last_insert_rowid()") as cursor:
-                incident_id = (await cursor.fetchone())[0]
-
-            # Проверяем и добавляем выбранные услуги
-            if services:
-                # Создаем заявку на услуги
-                await db.execute("""
-                    INSERT INTO service_requests (user_id, request_date, status, total_price)
-                    VALUES (?, datetime('now'), 'Pending', 0)
-                """, (current_user['id'],))
-
-                async with db.execute("SELECT last_insert_rowid()") as cursor:
-                    request_id = (await cursor.fetchone())[0]
-
-                total_price = 0
-                for service in services:
-                    service_id = int(service["id"])
-                    quantity = int(service["quantity"])
-
-                    # Проверяем, что услуга является бизнес-услугой
-                    async with db.execute("""
-                        SELECT price FROM services WHERE id = ? AND category = 'business'
-                    """, (service_id,)) as cursor:
-                        service_data = await cursor.fetchone()
-                        if not service_data:
-                            raise HTTPException(status_code=400, detail="Некорректная услуга.")
-                        price = service_data[0]
-
-                    # Добавляем услугу в заявку
-                    await db.execute("""
-                        INSERT INTO service_cart_items (request_id, service_id, quantity)
-                        VALUES (?, ?, ?)
-                    """, (request_id, service_id, quantity))
-                    total_price += price * quantity
-
-                # Обновляем общую стоимость заявки
-                await db.execute("""
-                    UPDATE service_requests SET total_price = ? WHERE id = ?
-                """, (total_price, request_id))
-
-            await db.commit()
-        except Exception as e:
-            await db.rollback()
-            raise HTTPException(status_code=500, detail=f"Ошибка создания заявки: {str(e)}")
+    try:
+        events = await write(_create_combined_request, current_user['id'], title, description, services)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка создания заявки: {str(e)}")
+    _publish_incident_events(events)
 
     return RedirectResponse(url="/incidents/my", status_code=303)
 
 
 @router1.get("/combined-request", response_class=HTMLResponse)
-async def combined_request_form(request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        # Отображаем только бизнес-услуги
-        async with db.execute("""
-            SELECT id, name, price, price_per 
-            FROM services 
-            WHERE category = 'business' AND is_active = 1
-        """) as cursor:
-            business_services = await cursor.fetchall()
+async def combined_request_form(request: Request, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    # Отображаем только бизнес-услуги
+    async with db.execute("""
+        SELECT id, name, price, price_per 
+        FROM services 
+        WHERE category = 'business' AND is_active = 1
+    """) as cursor:
+        business_services = await cursor.fetchall()
     return templates2.TemplateResponse("new_combined_form.html", {"request": request, "services": business_services, "user": current_user})
 
 
@@ -229,118 +543,54 @@ async def create_combined_request(
     current_user: dict = Depends(get_current_user)
 ):
     try:
-        # Преобразуем JSON-строку в список
-        services = json.loads(selectedServices)
-    except json.JSONDecodeError:
+        # Преобразуем JSON-строку в словарь {service_id: количество}
+        services = merge_items((service["id"], service["quantity"]) for service in json.loads(selectedServices))
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
         raise HTTPException(status_code=400, detail="Некорректный формат данных для услуг.")
 
-    async with aiosqlite.connect(DATABASE) as db:
-        try:
-            # Создаем инцидент
-            await db.execute("""
-                INSERT INTO incidents (title, description, status, created_at, updated_at, reporter_id)
-                VALUES (?, ?, 'open', datetime('now'), datetime('now'), ?)
-            """, (title, description, current_user['id']))
-
-            # Получаем ID инцидента
-            async with db.execute("SELECT last_insert_rowid()") as cursor:
-                incident_id = (await cursor.fetchone())[0]
-
-            # Проверяем и добавляем выбранные услуги
-            if services:
-                # Создаем заявку на услуги
-                await db.execute("""
-                    INSERT INTO service_requests (user_id, request_date, status, total_price)
-                    VALUES (?, datetime('now'), 'Pending', 0)
-                """, (current_user['id'],))
-
-                async with db.execute("SELECT last_insert_rowid()") as cursor:
-                    request_id = (await cursor.fetchone())[0]
-
-                total_price = 0
-                for service in services:
-                    service_id = int(service["id"])
-                    quantity = int(service["quantity"])
-
-                    # Проверяем, что услуга является бизнес-услугой
-                    async with db.execute("""
-                        SELECT price FROM services WHERE id = ? AND category = 'business'
-                    """, (service_id,)) as cursor:
-                        service_data = await cursor.fetchone()
-                        if not service_data:
-                            raise HTTPException(status_code=400, detail="Некорректная услуга.")
-                        price = service_data[0]
-
-                    # Добавляем услугу в заявку
-                    await db.execute("""
-                        INSERT INTO service_cart_items (request_id, service_id, quantity)
-                        VALUES (?, ?, ?)
-                    """, (request_id, service_id, quantity))
-                    total_price += price * quantity
-
-                # Обновляем общую стоимость заявки
-                await db.execute("""
-                    UPDATE service_requests SET total_price = ? WHERE id = ?
-                """, (total_price, request_id))
-
-            await db.commit()
-        except Exception as e:
-            await db.rollback()
-            raise HTTPException(status_code=500, detail=f"Ошибка создания заявки: {str(e)}")
+    try:
+        events = await write(_create_combined_request, current_user['id'], title, description, services)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка создания заявки: {str(e)}")
+    _publish_incident_events(events)
 
     return RedirectResponse(url="/incidents/my", status_code=303)
 
 
 @router1.get("/incidents/my", response_class=HTMLResponse)
-async def my_combined_requests(request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        db.row_factory = aiosqlite.Row
-        # Получаем инциденты пользователя
-        async with db.execute("""
-            SELECT id AS incident_id, title, status, created_at
-            FROM incidents
-            WHERE reporter_id = ?
-        """, (current_user['id'],)) as cursor:
-            incidents = [dict(row) for row in await cursor.fetchall()]  # Преобразуем Row в словари
-
-        # Для каждого инцидента получаем связанные услуги
-        for incident in incidents:
-            async with db.execute("""
-                SELECT s.name, sci.quantity
-                FROM service_cart_items sci
-                JOIN services s ON sci.service_id = s.id
-                WHERE sci.request_id = (
-                    SELECT id FROM service_requests WHERE user_id = ? AND request_date = ?
-                )
-            """, (current_user['id'], incident['created_at'])) as cursor:
-                incident['services'] = [dict(row) for row in await cursor.fetchall()]  # Преобразуем Row в словари
-
+async def my_combined_requests(request: Request, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    # Инциденты пользователя вместе с услугами связанных заявок
+    incidents = await _my_incidents(db, current_user['id'])
     return templates2.TemplateResponse("my_incidents.html", {"request": request, "incidents": incidents, "user": current_user})
 
+# Поиск по своим инцидентам
+@router1.get("/incidents/search", response_class=JSONResponse)
+async def search_incidents(q: str, page: int = 1, page_size: int = INCIDENT_SEARCH_PAGE_SIZE, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    return await _incident_search_response(db, current_user, q, page, page_size)
+
 @router1.get("/incidents/{incident_id}", response_class=HTMLResponse)
-async def incident_detail(incident_id: int, request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        db.row_factory = aiosqlite.Row  # Устанавливаем row_factory
-        async with db.execute("""
-            SELECT
-                i.id AS incident_id,
-                i.title,
-                i.description,
-                i.status,
-                i.created_at,
-                i.updated_at,
-                i.reporter_id,
-                i.assignee_id,
-                i.resolution_time,
-                u.username AS reporter_username
-            FROM incidents i
-            JOIN users u ON i.reporter_id = u.id
-            WHERE i.id = ?
-        """, (incident_id,)) as cursor:
-            incident = await cursor.fetchone()
-        if not incident:
-            raise HTTPException(status_code=404, detail="Инцидент не найден")
-        # Проверка доступа
-        if current_user['role'] not in ['employee', 'admin'] and incident['reporter_id'] != current_user['id']:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Доступ запрещен")
+async def incident_detail(incident_id: int, request: Request, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    db.row_factory = aiosqlite.Row  # Устанавливаем row_factory
+    async with db.execute("""
+        SELECT
+            i.id AS incident_id,
+            i.title,
+            i.description,
+            i.status,
+            i.created_at,
+            i.updated_at,
+            i.reporter_id,
+            i.assignee_id,
+            i.resolution_time,
+            u.username AS reporter_username
+        FROM incidents i
+        JOIN users u ON i.reporter_id = u.id
+        WHERE i.id = ?
+    """, (incident_id,)) as cursor:
+        incident = await cursor.fetchone()
+    if not incident:
+        raise HTTPException(status_code=404, detail="Инцидент не найден")
+    # Проверка доступа
+    if current_user['role'] not in ['employee', 'admin'] and incident['reporter_id'] != current_user['id']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Доступ запрещен")
     return templates2.TemplateResponse("incident_detail.html", {"request": request, "incident": incident, "user": current_user})
\ No newline at end of file
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import logging
+
+import aiosqlite
+
+from app.config import DATABASE
+
+logger = logging.getLogger(__name__)
+
+INCIDENT_STATUSES = ('open', 'in_progress', 'resolved', 'closed')
+
+# Ключ исполнителя для неназначенных инцидентов (assignee_id входит в первичный ключ и не может быть NULL)
+UNASSIGNED = 0
+
+# Счетчики инцидентов хранятся в incident_counters, по строке на (статус, исполнитель).
+# Обновляются в той же транзакции, что и создание инцидента или смена его статуса/исполнителя;
+# расхождения исправляет reconcile
+
+
+async def _apply(db: aiosqlite.Connection, changes: list):
+    await db.executemany("""
+        INSERT INTO incident_counters (status, assignee_id, count) VALUES (?, ?, ?)
+        ON CONFLICT(status, assignee_id) DO UPDATE SET count = count + excluded.count
+    """, [(status, assignee_id or UNASSIGNED, delta) for status, assignee_id, delta in changes])
+
+
+async def count_created(db: aiosqlite.Connection, status: str, assignee_id: int = None):
+    await _apply(db, [(status, assignee_id, 1)])
+
+
+async def count_transition(db: aiosqlite.Connection, old_status: str, old_assignee_id: int, new_status: str, new_assignee_id: int):
+    if (old_status, old_assignee_id or UNASSIGNED) == (new_status, new_assignee_id or UNASSIGNED):
+        return
+    await _apply(db, [(old_status, old_assignee_id, -1), (new_status, new_assignee_id, 1)])
+
+
+# Сводка для панели: число инцидентов по статусам и по исполнителям. Читается только
+# incident_counters (строк — статусы × исполнители), таблица incidents не сканируется
+async def incident_counts(db: aiosqlite.Connection) -> dict:
+    async with db.execute("""
+        SELECT c.status, c.assignee_id, u.username, c.count
+        FROM incident_counters c
+        LEFT JOIN users u ON u.id = c.assignee_id
+        WHERE c.count != 0
+        ORDER BY c.assignee_id
+    """) as cursor:
+        rows = await cursor.fetchall()
+    by_status = dict.fromkeys(INCIDENT_STATUSES, 0)
+    assignees = {}
+    for status, assignee_id, username, count in rows:
+        by_status[status] = by_status.get(status, 0) + count
+        assignee = assignees.get(assignee_id)
+        if assignee is None:
+            assignee = assignees[assignee_id] = {
+                "assignee_id": assignee_id or None,
+                "username": username,
+                "by_status": dict.fromkeys(INCIDENT_STATUSES, 0),
+                "total": 0,
+            }
+        assignee["by_status"][status] = assignee["by_status"].get(status, 0) + count
+        assignee["total"] += count
+    return {
+        "by_status": by_status,
+        "by_assignee": list(assignees.values()),
+        "total": sum(by_status.values()),
+    }
+
+
+# Пересчитывает счетчики по таблице incidents и исправляет расхождения (идемпотентно).
+# Возвращает число исправленных строк
+async def reconcile(db: aiosqlite.Connection) -> int:
+    async with db.execute("""
+        SELECT status, COALESCE(assignee_id, ?), COUNT(*) FROM incidents GROUP BY 1, 2
+    """, (UNASSIGNED,)) as cursor:
+        expected = {(status, assignee_id): count for status, assignee_id, count in await cursor.fetchall()}
+    async with db.execute("SELECT status, assignee_id, count FROM incident_counters") as cursor:
+        actual = {(status, assignee_id): count for status, assignee_id, count in await cursor.fetchall()}
+    fixes = [
+        (status, assignee_id, expected.get((status, assignee_id), 0))
+        for status, assignee_id in expected.keys() | actual.keys()
+        if expected.get((status, assignee_id), 0) != actual.get((status, assignee_id))
+    ]
+    await db.executemany("""
+        INSERT INTO incident_counters (status, assignee_id, count) VALUES (?, ?, ?)
+        ON CONFLICT(status, assignee_id) DO UPDATE SET count = excluded.count
+    """, fixes)
+    await db.execute("DELETE FROM incident_counters WHERE count = 0")
+    return len(fixes)
+
+
+async def run_reconcile(database: str = DATABASE) -> int:
+    async with aiosqlite.connect(database, isolation_level=None) as db:
+        await db.execute("PRAGMA busy_timeout = 5000")
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            fixed = await reconcile(db)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    return fixed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Сверка счетчиков инцидентов (таблица incident_counters) с таблицей incidents")
+    parser.add_argument("--database", default=DATABASE, help="Путь к файлу базы данных")
+    args = parser.parse_args()
+    fixed = asyncio.run(run_reconcile(args.database))
+    print(f"Исправлено счетчиков: {fixed}")
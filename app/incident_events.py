@@ -0,0 +1,72 @@
+import aiosqlite
+
+# Журнал изменений инцидентов (incident_events, только добавление): создание, смена статуса, смена исполнителя.
+# События пишутся в той же транзакции, что и само изменение; id (AUTOINCREMENT) не переиспользуется,
+# а единственный writer фиксирует транзакции по очереди, поэтому события становятся видны в порядке id
+# и клиент, читающий ленту после последнего полученного id, ничего не пропускает
+
+EVENT_CREATED = 'created'
+EVENT_STATUS = 'status'
+EVENT_ASSIGNED = 'assigned'
+
+
+# Записывает события и возвращает их в виде дельт ленты (для рассылки подписчикам после фиксации транзакции)
+async def _append(db: aiosqlite.Connection, events: list) -> list:
+    first_id = None
+    for event in events:
+        cursor = await db.execute("""
+            INSERT INTO incident_events (incident_id, event, status, assignee_id, created_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+        """, event)
+        first_id = first_id or cursor.lastrowid
+    if first_id is None:
+        return []
+    changes, _ = await incident_changes(db, first_id - 1, len(events))
+    return changes
+
+
+async def record_created(db: aiosqlite.Connection, incident_id: int, status: str, assignee_id: int = None) -> list:
+    return await _append(db, [(incident_id, EVENT_CREATED, status, assignee_id)])
+
+
+async def record_update(db: aiosqlite.Connection, incident_id: int, old_status: str, old_assignee_id: int, new_status: str, new_assignee_id: int) -> list:
+    events = []
+    if new_status != old_status:
+        events.append((incident_id, EVENT_STATUS, new_status, None))
+    if new_assignee_id != old_assignee_id:
+        events.append((incident_id, EVENT_ASSIGNED, None, new_assignee_id))
+    return await _append(db, events)
+
+
+async def last_event_id(db: aiosqlite.Connection) -> int:
+    async with db.execute("SELECT MAX(id) FROM incident_events") as cursor:
+        return (await cursor.fetchone())[0] or 0
+
+
+# Лента изменений после события after: не больше limit событий по возрастанию id.
+# Каждое событие — компактная дельта: created несет состояние инцидента целиком (тема, автор и его имя, статус, исполнитель),
+# status — новый статус, assigned — нового исполнителя (None — снят). Возвращает (события, есть ли еще)
+async def incident_changes(db: aiosqlite.Connection, after: int, limit: int):
+    async with db.execute("""
+        SELECT e.id, e.incident_id, e.event, e.status, e.assignee_id, e.created_at, i.title, i.reporter_id, u.username
+        FROM incident_events e
+        LEFT JOIN incidents i ON e.event = 'created' AND i.id = e.incident_id
+        LEFT JOIN users u ON u.id = i.reporter_id
+        WHERE e.id > ?
+        ORDER BY e.id
+        LIMIT ?
+    """, (after, limit + 1)) as cursor:
+        rows = await cursor.fetchall()
+    events = []
+    for event_id, incident_id, event, status, assignee_id, created_at, title, reporter_id, reporter_username in rows[:limit]:
+        change = {"id": event_id, "incident_id": incident_id, "event": event, "at": created_at}
+        if event == EVENT_CREATED:
+            change.update(
+                title=title, reporter_id=reporter_id, reporter_username=reporter_username, status=status, assignee_id=assignee_id
+            )
+        elif event == EVENT_STATUS:
+            change["status"] = status
+        else:
+            change["assignee_id"] = assignee_id
+        events.append(change)
+    return events, len(rows) > limit
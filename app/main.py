@@ -1,10 +1,10 @@
 import os
 import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from starlette.middleware import Middleware
 from starlette.responses import HTMLResponse, RedirectResponse
 from starlette.staticfiles import StaticFiles
-from starlette.middleware.sessions import SessionMiddleware
 from fastapi.templating import Jinja2Templates
 from app.auth import router as auth_router
 from app.services import router as services_router
@@ -14,6 +14,11 @@ from app.incident import router as incident_router
 from app.incident import router1 as incident_router1
 from app.auth import router1 as auth_router1
 from app.messaging import router1 as messaging_router1
+from app import db
+from app.config import DATABASE, DB_MIGRATE_ON_STARTUP
+from app.migrations import migrate
+from app.sessions import SessionMiddleware
+from app.retention import message_retention
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -22,13 +27,26 @@ logger = logging.getLogger(__name__)
 # Получаем директорию текущего файла
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Пул соединений и фоновая архивация сообщений принадлежат lifespan приложений; app и app1 в одном процессе делят их
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    if DB_MIGRATE_ON_STARTUP:
+        await migrate(DATABASE)
+    await db.startup()
+    message_retention.start()
+    try:
+        yield
+    finally:
+        await message_retention.stop()
+        await db.shutdown()
+
 # Инициализация приложения FastAPI
-app = FastAPI()
-app1 = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app1 = FastAPI(lifespan=lifespan)
 
 app.include_router(services_router)
-# Настройка сессий
-app.add_middleware(SessionMiddleware, secret_key='your-secret-key', session_cookie='session')
+# Настройка сессий: в cookie только идентификатор, данные хранятся на сервере (app.sessions)
+app.add_middleware(SessionMiddleware)
 
 # Подключение статических файлов
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
@@ -40,7 +58,7 @@ app.include_router(messaging_router)
 app.include_router(incident_router)
 
 # Подключение маршрутов Для клиента
-app1.add_middleware(SessionMiddleware, secret_key='your-secret-key', session_cookie='session')
+app1.add_middleware(SessionMiddleware)
 app1.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
 app1.include_router(auth_router1)
 app1.include_router(incident_router1)
@@ -1,15 +1,29 @@
 import os
+import json
+import asyncio
 import logging
 from asyncio import AbstractEventLoopPolicy
+from datetime import datetime, timezone
 
 from fastapi import APIRouter, Request, Depends, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 import aiosqlite
 from starlette.responses import JSONResponse
 
 from app.dependencies import get_current_user
-from app.config import BASE_DIR, DATABASE
+from app.config import (
+    BASE_DIR, CHAT_STREAM_KEEPALIVE, CHAT_PAGE_SIZE, CHAT_PAGE_MAX, CONTACTS_RECENT_LIMIT,
+    MESSAGE_BATCH_WINDOW, MESSAGE_BATCH_SIZE, MESSAGE_SEARCH_PAGE_SIZE, MESSAGE_SEARCH_PAGE_MAX, MESSAGE_SEARCH_CANDIDATES,
+    MESSAGE_DELETE_BATCH_SIZE, CONTACTS_SEARCH_LIMIT, CONTACTS_SEARCH_MAX
+)
+from app.db import get_db, pool, write, write_execute
+from app.conversations import record_messages, mark_read, delete_summary, unread_count, recent_conversations
+from app.chat_cache import message_cache
+from app.broker import chat_broker
+from app.blocks import block_index
+from app.batching import GroupCommitter
+from app.search import fts_query, snippet_html, marked_scores, SNIPPET_START, SNIPPET_END
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -18,65 +32,374 @@ router1 = APIRouter()
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "app", "templates"))
 templates2 = Jinja2Templates(directory=os.path.join(BASE_DIR, "app", "templates2"))
 
+# Страница истории переписки в порядке (timestamp, id) по возрастанию: сообщения строго раньше
+# курсора before = (timestamp, id) или последние, если курсор не задан.
+# Каждое направление читается по индексу idx_messages_pair_time (rowid — его последний столбец).
+# Возвращает (сообщения, есть ли более ранние)
+async def _history_page(db: aiosqlite.Connection, user_id: int, other_user_id: int, limit: int, before=None):
+    condition, cursor_params = "", ()
+    if before is not None:
+        condition = "AND (timestamp, id) < (?, ?)"
+        cursor_params = tuple(before)
+    async with db.execute(f"""
+        SELECT * FROM (
+            SELECT * FROM (
+                SELECT id, sender_id, receiver_id, content, timestamp FROM messages
+                WHERE sender_id = ? AND receiver_id = ? {condition}
+                ORDER BY timestamp DESC, id DESC LIMIT ?
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT id, sender_id, receiver_id, content, timestamp FROM messages
+                WHERE sender_id = ? AND receiver_id = ? {condition}
+                ORDER BY timestamp DESC, id DESC LIMIT ?
+            )
+        )
+        ORDER BY timestamp DESC, id DESC LIMIT ?
+    """, (user_id, other_user_id, *cursor_params, limit + 1,
+          other_user_id, user_id, *cursor_params, limit + 1, limit + 1)) as cursor:
+        rows = await cursor.fetchall()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
+# Курсор для загрузки более ранних сообщений: (timestamp, id) самого раннего сообщения страницы
+def _history_cursor(messages, has_more: bool):
+    if not has_more or not messages:
+        return None
+    return {"timestamp": messages[0][4], "id": messages[0][0]}
+
+# Сообщения переписки с id > since_id по возрастанию id
+async def _messages_since(db: aiosqlite.Connection, user_id: int, other_user_id: int, since_id: int):
+    messages = await message_cache.since(db, user_id, other_user_id, since_id)
+    if messages is not None:
+        return messages
+    async with db.execute("""
+        SELECT id, sender_id, receiver_id, content, timestamp
+        FROM messages
+        WHERE ((sender_id = ? AND receiver_id = ?)
+           OR (sender_id = ? AND receiver_id = ?))
+          AND id > ?
+        ORDER BY id ASC
+    """, (user_id, other_user_id, other_user_id, user_id, since_id)) as cursor:
+        return await cursor.fetchall()
+
+# Записывает пачку сообщений [(sender_id, receiver_id, content, timestamp)] одним executemany
+# и обновляет сводки переписок в той же транзакции (выполняется на пишущем соединении).
+# Пачка вставляется одним соединением подряд, поэтому ее id (AUTOINCREMENT) идут последовательно
+async def _store_messages(db: aiosqlite.Connection, messages: list) -> list:
+    await db.executemany("""
+        INSERT INTO messages (sender_id, receiver_id, content, timestamp, is_read)
+        VALUES (?, ?, ?, ?, 0)
+    """, messages)
+    async with db.execute("SELECT last_insert_rowid()") as cursor:
+        last_id = (await cursor.fetchone())[0]
+    message_ids = list(range(last_id - len(messages) + 1, last_id + 1))
+    await record_messages(db, [
+        (message_id, sender_id, receiver_id, timestamp)
+        for message_id, (sender_id, receiver_id, _, timestamp) in zip(message_ids, messages)
+    ])
+    return message_ids
+
+# Сообщения от параллельных запросов записываются пачками (group commit)
+message_batcher = GroupCommitter(_store_messages, MESSAGE_BATCH_WINDOW, MESSAGE_BATCH_SIZE)
+
+# Удаляет до batch_size сообщений переписки с id не больше up_to_id — сначала из messages, затем из архива.
+# Возвращает число удаленных
+async def _delete_conversation_batch(db: aiosqlite.Connection, user_id: int, other_user_id: int, up_to_id: int, batch_size: int) -> int:
+    deleted = 0
+    for table in ("messages", "messages_archive"):
+        cursor = await db.execute(f"""
+            DELETE FROM {table} WHERE id IN (
+                SELECT id FROM {table}
+                WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)) AND id <= ?
+                LIMIT ?
+            )
+        """, (user_id, other_user_id, other_user_id, user_id, up_to_id, batch_size - deleted))
+        deleted += cursor.rowcount
+        if deleted >= batch_size:
+            break
+    return deleted
+
+# Удаляет сводку, если во время удаления в переписке не появилось новых сообщений
+async def _delete_conversation_summary(db: aiosqlite.Connection, user_id: int, other_user_id: int):
+    async with db.execute("""
+        SELECT 1 FROM messages
+        WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
+        LIMIT 1
+    """, (user_id, other_user_id, other_user_id, user_id)) as cursor:
+        if await cursor.fetchone() is None:
+            await delete_summary(db, user_id, other_user_id)
+
+# Удаляет переписку пачками: каждая пачка — отдельная короткая транзакция writer, между ними
+# выполняются задания других запросов. Удаляются сообщения, отправленные до начала удаления
+async def _delete_conversation(user_id: int, other_user_id: int, batch_size: int = MESSAGE_DELETE_BATCH_SIZE) -> int:
+    async with pool.acquire() as db:
+        async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'") as cursor:
+            row = await cursor.fetchone()
+    up_to_id = row[0] if row else 0
+    deleted = 0
+    while True:
+        count = await write(_delete_conversation_batch, user_id, other_user_id, up_to_id, batch_size)
+        deleted += count
+        if count < batch_size:
+            break
+        await asyncio.sleep(0)
+    await write(_delete_conversation_summary, user_id, other_user_id)
+    return deleted
+
+# Кандидаты поиска: последние MESSAGE_SEARCH_CANDIDATES совпадений в переписках пользователя
+# (с other_user_id — в одной переписке) с выделением совпадений; лишняя строка показывает, что совпадений больше.
+# Совпадения читаются из FTS5 от новых к старым одним курсором, чужие сообщения отбрасываются по первичному ключу.
+# Проверка MATCH для каждого сообщения пользователя (по rowid) дороже: без префиксного индекса FTS5 заново
+# собирает списки документов для слова с "*" на каждой строке. bm25() не используется, как и в поиске по инцидентам
+async def _search_candidates(db: aiosqlite.Connection, user_id: int, match: str, other_user_id: int = None):
+    condition, params = "(m.sender_id = ? OR m.receiver_id = ?)", (user_id, user_id)
+    if other_user_id is not None:
+        condition = "((m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?))"
+        params = (user_id, other_user_id, other_user_id, user_id)
+    async with db.execute(f"""
+        SELECT m.id, highlight(messages_fts, 0, ?, ?)
+        FROM messages_fts
+        CROSS JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ? AND {condition}
+        ORDER BY messages_fts.rowid DESC
+        LIMIT ?
+    """, (SNIPPET_START, SNIPPET_END, match, *params, MESSAGE_SEARCH_CANDIDATES + 1)) as cursor:
+        return await cursor.fetchall()
+
+# Поиск по сообщениям переписок пользователя (FTS5), по релевантности: ранжируются только сообщения
+# пользователя, данные сообщения и фрагмент дочитываются только для limit строк страницы. Возвращает (строки, truncated):
+# строка — (id, id собеседника, имя собеседника, отправитель, время, фрагмент с маркерами выделения);
+# truncated — совпадений больше MESSAGE_SEARCH_CANDIDATES и более старые не ранжировались
+async def _search_messages(db: aiosqlite.Connection, user_id: int, match: str, limit: int, offset: int, other_user_id: int = None):
+    candidates = await _search_candidates(db, user_id, match, other_user_id)
+    truncated = len(candidates) > MESSAGE_SEARCH_CANDIDATES
+    candidates = candidates[:MESSAGE_SEARCH_CANDIDATES]
+    scores = marked_scores([candidate[1:] for candidate in candidates], (1.0,))
+    ranked = sorted(zip(scores, candidates), key=lambda item: (-item[0], -item[1][0]))[offset:offset + limit]
+    if not ranked:
+        return [], truncated
+    message_ids = [candidate[0] for _, candidate in ranked]
+    # FTS5 получает только диапазон rowid (уже просмотренный при выборе кандидатов), а не каждый id по отдельности:
+    # иначе запрос со словом "*" выполнялся бы заново для каждой строки страницы
+    async with db.execute("""
+        SELECT m.id, u.id, u.username, m.sender_id, m.timestamp,
+               snippet(messages_fts, 0, ?, ?, '…', 16)
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN users u ON u.id = CASE WHEN m.sender_id = ? THEN m.receiver_id ELSE m.sender_id END
+        WHERE messages_fts MATCH ? AND messages_fts.rowid BETWEEN ? AND ?
+          AND +messages_fts.rowid IN (SELECT value FROM json_each(?))
+    """, (SNIPPET_START, SNIPPET_END, user_id, match, min(message_ids), max(message_ids), json.dumps(message_ids))) as cursor:
+        rows = {row[0]: row for row in await cursor.fetchall()}
+    return [rows[message_id] for message_id in message_ids if message_id in rows], truncated
+
+# Ответ поиска: страница результатов, признак следующей страницы и признак усеченного набора кандидатов
+async def _search_response(db: aiosqlite.Connection, user_id: int, q: str, page: int, page_size: int, other_user_id: int = None):
+    page = max(page, 1)
+    page_size = max(1, min(page_size, MESSAGE_SEARCH_PAGE_MAX))
+    match = fts_query(q)
+    rows, truncated = [], False
+    if match is not None:
+        rows, truncated = await _search_messages(db, user_id, match, page_size + 1, (page - 1) * page_size, other_user_id)
+    return JSONResponse(content={
+        "results": [{
+            "id": row[0],
+            "other_user_id": row[1],
+            "other_username": row[2],
+            "sender_id": row[3],
+            "timestamp": row[4],
+            "snippet": snippet_html(row[5])
+        } for row in rows[:page_size]],
+        "page": page,
+        "has_more": len(rows) > page_size,
+        "truncated": truncated
+    })
+
+# Пользователи (кроме user_id), чье имя начинается с prefix, по алфавиту без учета регистра (латиницы).
+# Диапазонный поиск по индексу idx_users_username_nocase; after = (username, id) — курсор следующей страницы.
+# Возвращает (пользователи, есть ли еще)
+async def _search_users(db: aiosqlite.Connection, user_id: int, prefix: str, limit: int, after=None):
+    condition, cursor_params = "", ()
+    if after is not None:
+        condition = "AND (username COLLATE NOCASE, id) > (?, ?)"
+        cursor_params = tuple(after)
+    async with db.execute(f"""
+        SELECT id, username FROM users
+        WHERE username COLLATE NOCASE >= ? AND username COLLATE NOCASE < ? AND id != ? {condition}
+        ORDER BY username COLLATE NOCASE, id
+        LIMIT ?
+    """, (prefix, prefix + "\U0010ffff", user_id, *cursor_params, limit + 1)) as cursor:
+        rows = await cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+async def _users_response(db: aiosqlite.Connection, user_id: int, q: str, limit: int, after_username: str = None, after_id: int = None):
+    limit = max(1, min(limit, CONTACTS_SEARCH_MAX))
+    prefix = q.strip()
+    users, has_more = [], False
+    if prefix:
+        after = (after_username, after_id) if after_username is not None and after_id is not None else None
+        users, has_more = await _search_users(db, user_id, prefix, limit, after)
+    blocked_users = await block_index.block_list(db, user_id)
+    return JSONResponse(content={
+        "results": [{"id": row[0], "username": row[1], "blocked": row[0] in blocked_users} for row in users],
+        "next_cursor": {"username": users[-1][1], "id": users[-1][0]} if has_more else None
+    })
+
+# Данные страницы контактов: недавние переписки, заблокированные и найденные по user_q пользователи.
+# Таблица users целиком не читается
+async def _contacts_context(db: aiosqlite.Connection, user_id: int, user_q: str = None) -> dict:
+    blocked_users = await block_index.block_list(db, user_id)
+    # Недавние переписки с числом непрочитанных — из сводок conversations
+    recent = await recent_conversations(db, user_id, CONTACTS_RECENT_LIMIT)
+    blocked = []
+    if blocked_users:
+        placeholders = ", ".join("?" * len(blocked_users))
+        async with db.execute(
+            f"SELECT id, username FROM users WHERE id IN ({placeholders}) ORDER BY username COLLATE NOCASE",
+            tuple(blocked_users),
+        ) as cursor:
+            blocked = await cursor.fetchall()
+    users, has_more = [], False
+    if user_q and user_q.strip():
+        users, has_more = await _search_users(db, user_id, user_q.strip(), CONTACTS_SEARCH_LIMIT)
+    return {
+        "recent": recent,
+        "blocked": blocked,
+        "users": users,
+        "users_more": has_more,
+        "user_q": user_q or "",
+        "blocked_users": blocked_users,
+    }
+
+def _message_dict(message) -> dict:
+    return {
+        "id": message[0],
+        "sender_id": message[1],
+        "receiver_id": message[2],
+        "content": message[3],
+        "timestamp": message[4]
+    }
+
+# Добавляет только что записанное сообщение в кэш и рассылает его подписчикам переписки
+def _publish_message(message: tuple):
+    message_cache.add(message)
+    chat_broker.publish(message_cache.key(message[1], message[2]), ("message", message))
+
+# Ответ на опрос чата: только сообщения новее курсора since_id.
+# ETag — id последнего сообщения; если новых сообщений нет, отдается 304 (по If-None-Match) или 204 без тела
+def _messages_response(request: Request, messages, since_id: int):
+    last_id = messages[-1][0] if messages else since_id
+    etag = f'"{last_id}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if not messages and since_id:
+        return Response(status_code=204, headers=headers)
+    messages_list = [_message_dict(msg) for msg in messages]
+    return JSONResponse(content={"messages": messages_list, "last_id": last_id}, headers=headers)
+
+def _sse_message(message) -> str:
+    return f"id: {message[0]}\ndata: {json.dumps(_message_dict(message), ensure_ascii=False)}\n\n"
+
+# События push-канала переписки. Подписка оформляется до дочитывания из базы, чтобы не потерять
+# сообщения, отправленные в промежутке. Соединения из пула берутся только на время чтения
+async def _message_events(user_id: int, other_user_id: int, since_id: int):
+    with chat_broker.subscribe(message_cache.key(user_id, other_user_id)) as subscription:
+        catch_up = True
+        while True:
+            if catch_up:
+                async with pool.acquire() as db:
+                    missed = await _messages_since(db, user_id, other_user_id, since_id)
+                for message in missed:
+                    since_id = message[0]
+                    yield _sse_message(message)
+                catch_up = False
+            try:
+                event = await subscription.get(CHAT_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Комментарий не дает прокси закрыть простаивающее соединение; заодно дочитываются
+                # сообщения, отправленные через другой процесс приложения (брокер работает внутри процесса)
+                yield ": keepalive\n\n"
+                catch_up = True
+                continue
+            if event is None:
+                # Отключены брокером за отставание: клиент переподключится с Last-Event-ID
+                return
+            kind, payload = event
+            if kind == "blocked":
+                if payload[1] == user_id:
+                    yield "event: blocked\ndata: {}\n\n"
+                    return
+                continue
+            if payload[0] > since_id:
+                since_id = payload[0]
+                yield _sse_message(payload)
+
+# Ответ push-канала; при переподключении браузер передает id последнего события в Last-Event-ID
+def _message_stream(request: Request, user_id: int, other_user_id: int, since_id: int):
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since_id = int(last_event_id)
+    return StreamingResponse(
+        _message_events(user_id, other_user_id, since_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Маршрут для отображения списка контактов (пользователей)
 @router.get("/messages/contacts", response_class=HTMLResponse)
-async def contacts(request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        # Получаем список пользователей, исключая текущего
-        async with db.execute("""
-            SELECT id, username FROM users WHERE id != ?
-        """, (current_user['id'],)) as cursor:
-            users = await cursor.fetchall()
-        # Получаем список заблокированных пользователей
-        async with db.execute("""
-            SELECT blocked_user_id FROM blocked_users WHERE user_id = ?
-        """, (current_user['id'],)) as cursor:
-            blocked_users = [row[0] for row in await cursor.fetchall()]
+async def contacts(request: Request, user_q: str = None, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    context = await _contacts_context(db, current_user['id'], user_q)
     return templates.TemplateResponse("contacts.html", {
         "request": request,
-        "users": users,
-        "blocked_users": blocked_users,
+        **context,
         "user": current_user
     })
 
+# Поиск пользователей по началу имени (подсказки при вводе)
+@router.get("/messages/users/search", response_class=JSONResponse)
+async def search_users(q: str, limit: int = CONTACTS_SEARCH_LIMIT, after_username: str = None, after_id: int = None, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    return await _users_response(db, current_user['id'], q, limit, after_username, after_id)
+
+# Поиск по истории своих переписок: ранжированные результаты с выделенными фрагментами (snippet — готовый HTML)
+@router.get("/messages/search", response_class=JSONResponse)
+async def search_messages(q: str, page: int = 1, page_size: int = MESSAGE_SEARCH_PAGE_SIZE, other_user_id: int = None, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    return await _search_response(db, current_user['id'], q, page, page_size, other_user_id)
+
 # Маршрут для начала или продолжения переписки с другим пользователем
 @router.get("/messages/chat/{other_user_id}", response_class=HTMLResponse)
 async def chat(other_user_id: int, request: Request, current_user: dict = Depends(get_current_user)):
     if other_user_id == current_user['id']:
         raise HTTPException(status_code=400, detail="Нельзя писать самому себе.")
 
-    async with aiosqlite.connect(DATABASE) as db:
+    # Соединение из пула нужно только для чтения и возвращается до записи отметки о прочтении
+    async with pool.acquire() as db:
         # Проверяем, не заблокирован ли текущий пользователь получателем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (other_user_id, current_user['id'])) as cursor:
-            is_blocked = await cursor.fetchone()
-            if is_blocked:
-                error_message = "Вы не можете отправить сообщение этому пользователю."
-                return templates.TemplateResponse("chat.html", {
-                    "request": request,
-                    "messages": [],
-                    "other_user": None,
-                    "error": error_message,
-                    "user": current_user
-                })
+        if await block_index.is_blocked(db, current_user['id'], other_user_id):
+            error_message = "Вы не можете отправить сообщение этому пользователю."
+            return templates.TemplateResponse("chat.html", {
+                "request": request,
+                "messages": [],
+                "other_user": None,
+                "error": error_message,
+                "user": current_user
+            })
         # Получаем информацию о другом пользователе
         async with db.execute("SELECT id, username FROM users WHERE id = ?", (other_user_id,)) as cursor:
             other_user = await cursor.fetchone()
             if not other_user:
                 raise HTTPException(status_code=404, detail="Пользователь не найден.")
-        # Получаем сообщения между пользователями
-        async with db.execute("""
-            SELECT sender_id, receiver_id, content, timestamp
-            FROM messages
-            WHERE (sender_id = ? AND receiver_id = ?)
-               OR (sender_id = ? AND receiver_id = ?)
-            ORDER BY timestamp ASC
-        """, (current_user['id'], other_user_id, other_user_id, current_user['id'])) as cursor:
-            messages = await cursor.fetchall()
+        # Получаем последнюю страницу переписки; более ранние сообщения подгружаются по курсору
+        messages, has_more = await _history_page(db, current_user['id'], other_user_id, CHAT_PAGE_SIZE)
+        unread = await unread_count(db, current_user['id'], other_user_id)
+    # Открытие чата отмечает входящие сообщения прочитанными (запись — только если есть непрочитанные)
+    if unread:
+        await write(mark_read, current_user['id'], other_user_id)
     return templates.TemplateResponse("chat.html", {
         "request": request,
-        "messages": messages,
+        "messages": [message[1:] for message in messages],
+        "last_message_id": max((message[0] for message in messages), default=0),
+        "history_cursor": _history_cursor(messages, has_more),
         "other_user": other_user,
         "user": current_user
     })
@@ -87,29 +410,24 @@ async def send_message(other_user_id: int, request: Request, content: str = Form
     if other_user_id == current_user['id']:
         error_message = "Нельзя отправить сообщение самому себе."
         return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
-    async with aiosqlite.connect(DATABASE) as db:
+    # Соединение из пула нужно только для проверок блокировки и возвращается до ожидания групповой записи:
+    # иначе размер пачки ограничивался бы размером пула, а чтения остальных запросов ждали бы соединение
+    async with pool.acquire() as db:
         # Проверяем, не заблокирован ли отправитель получателем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (other_user_id, current_user['id'])) as cursor:
-            is_blocked = await cursor.fetchone()
-            if is_blocked:
-                error_message = "Вы не можете отправить сообщение этому пользователю."
-                return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
+        blocked = await block_index.is_blocked(db, current_user['id'], other_user_id)
         # Проверяем, не заблокирован ли получатель отправителем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (current_user['id'], other_user_id)) as cursor:
-            is_blocked_by_sender = await cursor.fetchone()
-            if is_blocked_by_sender:
-                error_message = "Вы заблокировали этого пользователя."
-                return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
-        # Отправляем сообщение
-        await db.execute("""
-            INSERT INTO messages (sender_id, receiver_id, content, timestamp, is_read)
-            VALUES (?, ?, ?, datetime('now'), 0)
-        """, (current_user['id'], other_user_id, content))
-        await db.commit()
+        blocking = not blocked and await block_index.is_blocked(db, other_user_id, current_user['id'])
+    if blocked:
+        error_message = "Вы не можете отправить сообщение этому пользователю."
+        return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
+    if blocking:
+        error_message = "Вы заблокировали этого пользователя."
+        return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
+    # Отправляем сообщение, добавляем его в кэш переписки и рассылаем подключенным клиентам
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    # Ответ отправляется только после фиксации транзакции с этим сообщением
+    message_id = await message_batcher.submit((current_user['id'], other_user_id, content, timestamp))
+    _publish_message((message_id, current_user['id'], other_user_id, content, timestamp))
     return RedirectResponse(url=f"/messages/chat/{other_user_id}", status_code=303)
 
 # Маршрут для блокировки пользователя
@@ -117,73 +435,75 @@ async def send_message(other_user_id: int, request: Request, content: str = Form
 async def block_user(other_user_id: int, current_user: dict = Depends(get_current_user)):
     if other_user_id == current_user['id']:
         raise HTTPException(status_code=400, detail="Нельзя заблокировать самого себя.")
-    async with aiosqlite.connect(DATABASE) as db:
-        try:
-            await db.execute("""
-                INSERT INTO blocked_users (user_id, blocked_user_id)
-                VALUES (?, ?)
-            """, (current_user['id'], other_user_id))
-            await db.commit()
-        except aiosqlite.IntegrityError:
-            # Пользователь уже заблокирован
-            pass
+    try:
+        await write_execute("""
+            INSERT INTO blocked_users (user_id, blocked_user_id)
+            VALUES (?, ?)
+        """, (current_user['id'], other_user_id))
+    except aiosqlite.IntegrityError:
+        # Пользователь уже заблокирован
+        pass
+    block_index.block(current_user['id'], other_user_id)
+    # Закрываем push-канал заблокированного пользователя
+    chat_broker.publish(message_cache.key(current_user['id'], other_user_id), ("blocked", (current_user['id'], other_user_id)))
     return RedirectResponse(url="/messages/contacts", status_code=303)
 
 # Маршрут для разблокировки пользователя
 @router.post("/messages/unblock/{other_user_id}")
 async def unblock_user(other_user_id: int, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        await db.execute("""
-            DELETE FROM blocked_users
-            WHERE user_id = ? AND blocked_user_id = ?
-        """, (current_user['id'], other_user_id))
-        await db.commit()
+    await write_execute("""
+        DELETE FROM blocked_users
+        WHERE user_id = ? AND blocked_user_id = ?
+    """, (current_user['id'], other_user_id))
+    block_index.unblock(current_user['id'], other_user_id)
     return RedirectResponse(url="/messages/contacts", status_code=303)
 
 # Маршрут для удаления переписки с другим пользователем
 @router.post("/messages/delete-conversation/{other_user_id}")
 async def delete_conversation(other_user_id: int, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        # Удаляем сообщения, где текущий пользователь является отправителем или получателем с данным пользователем
-        await db.execute("""
-            DELETE FROM messages
-            WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
-        """, (current_user['id'], other_user_id, other_user_id, current_user['id']))
-        await db.commit()
+    # Удаляем сообщения, где текущий пользователь является отправителем или получателем с данным пользователем
+    await _delete_conversation(current_user['id'], other_user_id)
+    message_cache.invalidate(current_user['id'], other_user_id)
     return RedirectResponse(url="/messages/contacts", status_code=303)
 
+# Страница более ранних сообщений переписки по курсору (timestamp, id)
+@router.get("/messages/history/{other_user_id}", response_class=JSONResponse)
+async def message_history(other_user_id: int, before_timestamp: str, before_id: int, limit: int = CHAT_PAGE_SIZE, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    if other_user_id == current_user['id']:
+        return JSONResponse(content={"error": "Нельзя писать самому себе."}, status_code=400)
+
+    # Проверяем, не заблокирован ли текущий пользователь получателем
+    if await block_index.is_blocked(db, current_user['id'], other_user_id):
+        return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+    messages, has_more = await _history_page(db, current_user['id'], other_user_id, limit, (before_timestamp, before_id))
+    return JSONResponse(content={
+        "messages": [_message_dict(message) for message in messages],
+        "next_cursor": _history_cursor(messages, has_more)
+    })
+
+# Push-канал переписки (Server-Sent Events): новые сообщения приходят сразу после отправки
+@router.get("/messages/stream/{other_user_id}")
+async def stream_messages(other_user_id: int, request: Request, since_id: int = 0, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    if other_user_id == current_user['id']:
+        return JSONResponse(content={"error": "Нельзя писать самому себе."}, status_code=400)
+
+    # Проверяем, не заблокирован ли текущий пользователь получателем
+    if await block_index.is_blocked(db, current_user['id'], other_user_id):
+        return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
+    return _message_stream(request, current_user['id'], other_user_id, since_id)
+
 @router.get("/messages/get/{other_user_id}", response_class=JSONResponse)
-async def get_messages(other_user_id: int, current_user: dict = Depends(get_current_user)):
+async def get_messages(other_user_id: int, request: Request, since_id: int = 0, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
     if other_user_id == current_user['id']:
         return JSONResponse(content={"error": "Нельзя писать самому себе."}, status_code=400)
 
-    async with aiosqlite.connect(DATABASE) as db:
-        # Проверяем, не заблокирован ли текущий пользователь получателем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (other_user_id, current_user['id'])) as cursor:
-            is_blocked = await cursor.fetchone()
-            if is_blocked:
-                return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
-        # Получаем сообщения между пользователями
-        async with db.execute("""
-            SELECT sender_id, receiver_id, content, timestamp
-            FROM messages
-            WHERE (sender_id = ? AND receiver_id = ?)
-               OR (sender_id = ? AND receiver_id = ?)
-            ORDER BY timestamp ASC
-        """, (current_user['id'], other_user_id, other_user_id, current_user['id'])) as cursor:
-            messages = await cursor.fetchall()
-        # Формируем список сообщений
-        messages_list = []
-        for msg in messages:
-            messages_list.append({
-                "sender_id": msg[0],
-                "receiver_id": msg[1],
-                "content": msg[2],
-                "timestamp": msg[3]
-            })
-    return JSONResponse(content={"messages": messages_list})
+    # Проверяем, не заблокирован ли текущий пользователь получателем
+    if await block_index.is_blocked(db, current_user['id'], other_user_id):
+        return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
+    # Получаем только сообщения новее курсора (since_id = 0 — вся переписка)
+    messages = await _messages_since(db, current_user['id'], other_user_id, since_id)
+    return _messages_response(request, messages, since_id)
 
 
 # ----------------------------------------------------------------------
@@ -198,63 +518,58 @@ async def get_messages(other_user_id: int, current_user: dict = Depends(get_curr
 
 # Маршрут для отображения списка контактов (пользователей)
 @router1.get("/messages/contacts", response_class=HTMLResponse)
-async def contacts(request: Request, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        # Получаем список пользователей, исключая текущего
-        async with db.execute("""
-            SELECT id, username FROM users WHERE id != ?
-        """, (current_user['id'],)) as cursor:
-            users = await cursor.fetchall()
-        # Получаем список заблокированных пользователей
-        async with db.execute("""
-            SELECT blocked_user_id FROM blocked_users WHERE user_id = ?
-        """, (current_user['id'],)) as cursor:
-            blocked_users = [row[0] for row in await cursor.fetchall()]
+async def contacts(request: Request, user_q: str = None, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    context = await _contacts_context(db, current_user['id'], user_q)
     return templates2.TemplateResponse("contacts.html", {
         "request": request,
-        "users": users,
-        "blocked_users": blocked_users,
+        **context,
         "user": current_user
     })
 
+# Поиск пользователей по началу имени (подсказки при вводе)
+@router1.get("/messages/users/search", response_class=JSONResponse)
+async def search_users(q: str, limit: int = CONTACTS_SEARCH_LIMIT, after_username: str = None, after_id: int = None, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    return await _users_response(db, current_user['id'], q, limit, after_username, after_id)
+
+# Поиск по истории своих переписок: ранжированные результаты с выделенными фрагментами (snippet — готовый HTML)
+@router1.get("/messages/search", response_class=JSONResponse)
+async def search_messages(q: str, page: int = 1, page_size: int = MESSAGE_SEARCH_PAGE_SIZE, other_user_id: int = None, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    return await _search_response(db, current_user['id'], q, page, page_size, other_user_id)
+
 # Маршрут для начала или продолжения переписки с другим пользователем
 @router1.get("/messages/chat/{other_user_id}", response_class=HTMLResponse)
 async def chat(other_user_id: int, request: Request, current_user: dict = Depends(get_current_user)):
     if other_user_id == current_user['id']:
         raise HTTPException(status_code=400, detail="Нельзя писать самому себе.")
 
-    async with aiosqlite.connect(DATABASE) as db:
+    # Соединение из пула нужно только для чтения и возвращается до записи отметки о прочтении
+    async with pool.acquire() as db:
         # Проверяем, не заблокирован ли текущий пользователь получателем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (other_user_id, current_user['id'])) as cursor:
-            is_blocked = await cursor.fetchone()
-            if is_blocked:
-                error_message = "Вы не можете отправить сообщение этому пользователю."
-                return templates2.TemplateResponse("chat.html", {
-                    "request": request,
-                    "messages": [],
-                    "other_user": None,
-                    "error": error_message,
-                    "user": current_user
-                })
+        if await block_index.is_blocked(db, current_user['id'], other_user_id):
+            error_message = "Вы не можете отправить сообщение этому пользователю."
+            return templates2.TemplateResponse("chat.html", {
+                "request": request,
+                "messages": [],
+                "other_user": None,
+                "error": error_message,
+                "user": current_user
+            })
         # Получаем информацию о другом пользователе
         async with db.execute("SELECT id, username FROM users WHERE id = ?", (other_user_id,)) as cursor:
             other_user = await cursor.fetchone()
             if not other_user:
                 raise HTTPException(status_code=404, detail="Пользователь не найден.")
-        # Получаем сообщения между пользователями
-        async with db.execute("""
-            SELECT sender_id, receiver_id, content, timestamp
-            FROM messages
-            WHERE (sender_id = ? AND receiver_id = ?)
-               OR (sender_id = ? AND receiver_id = ?)
-            ORDER BY timestamp ASC
-        """, (current_user['id'], other_user_id, other_user_id, current_user['id'])) as cursor:
-            messages = await cursor.fetchall()
+        # Получаем последнюю страницу переписки; более ранние сообщения подгружаются по курсору
+        messages, has_more = await _history_page(db, current_user['id'], other_user_id, CHAT_PAGE_SIZE)
+        unread = await unread_count(db, current_user['id'], other_user_id)
+    # Открытие чата отмечает входящие сообщения прочитанными (запись — только если есть непрочитанные)
+    if unread:
+        await write(mark_read, current_user['id'], other_user_id)
     return templates2.TemplateResponse("chat.html", {
         "request": request,
-        "messages": messages,
+        "messages": [message[1:] for message in messages],
+        "last_message_id": max((message[0] for message in messages), default=0),
+        "history_cursor": _history_cursor(messages, has_more),
         "other_user": other_user,
         "user": current_user
     })
@@ -265,29 +580,24 @@ async def send_message(other_user_id: int, request: Request, content: str = Form
     if other_user_id == current_user['id']:
         error_message = "Нельзя отправить сообщение самому себе."
         return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
-    async with aiosqlite.connect(DATABASE) as db:
+    # Соединение из пула нужно только для проверок блокировки и возвращается до ожидания групповой записи:
+    # иначе размер пачки ограничивался бы размером пула, а чтения остальных запросов ждали бы соединение
+    async with pool.acquire() as db:
         # Проверяем, не заблокирован ли отправитель получателем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (other_user_id, current_user['id'])) as cursor:
-            is_blocked = await cursor.fetchone()
-            if is_blocked:
-                error_message = "Вы не можете отправить сообщение этому пользователю."
-                return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
+        blocked = await block_index.is_blocked(db, current_user['id'], other_user_id)
         # Проверяем, не заблокирован ли получатель отправителем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (current_user['id'], other_user_id)) as cursor:
-            is_blocked_by_sender = await cursor.fetchone()
-            if is_blocked_by_sender:
-                error_message = "Вы заблокировали этого пользователя."
-                return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
-        # Отправляем сообщение
-        await db.execute("""
-            INSERT INTO messages (sender_id, receiver_id, content, timestamp, is_read)
-            VALUES (?, ?, ?, datetime('now'), 0)
-        """, (current_user['id'], other_user_id, content))
-        await db.commit()
+        blocking = not blocked and await block_index.is_blocked(db, other_user_id, current_user['id'])
+    if blocked:
+        error_message = "Вы не можете отправить сообщение этому пользователю."
+        return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
+    if blocking:
+        error_message = "Вы заблокировали этого пользователя."
+        return RedirectResponse(url=f"/messages/chat/{other_user_id}?error={error_message}", status_code=303)
+    # Отправляем сообщение, добавляем его в кэш переписки и рассылаем подключенным клиентам
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    # Ответ отправляется только после фиксации транзакции с этим сообщением
+    message_id = await message_batcher.submit((current_user['id'], other_user_id, content, timestamp))
+    _publish_message((message_id, current_user['id'], other_user_id, content, timestamp))
     return RedirectResponse(url=f"/messages/chat/{other_user_id}", status_code=303)
 
 # Маршрут для блокировки пользователя
@@ -295,70 +605,72 @@ async def send_message(other_user_id: int, request: Request, content: str = Form
 async def block_user(other_user_id: int, current_user: dict = Depends(get_current_user)):
     if other_user_id == current_user['id']:
         raise HTTPException(status_code=400, detail="Нельзя заблокировать самого себя.")
-    async with aiosqlite.connect(DATABASE) as db:
-        try:
-            await db.execute("""
-                INSERT INTO blocked_users (user_id, blocked_user_id)
-                VALUES (?, ?)
-            """, (current_user['id'], other_user_id))
-            await db.commit()
-        except aiosqlite.IntegrityError:
-            # Пользователь уже заблокирован
-            pass
+    try:
+        await write_execute("""
+            INSERT INTO blocked_users (user_id, blocked_user_id)
+            VALUES (?, ?)
+        """, (current_user['id'], other_user_id))
+    except aiosqlite.IntegrityError:
+        # Пользователь уже заблокирован
+        pass
+    block_index.block(current_user['id'], other_user_id)
+    # Закрываем push-канал заблокированного пользователя
+    chat_broker.publish(message_cache.key(current_user['id'], other_user_id), ("blocked", (current_user['id'], other_user_id)))
     return RedirectResponse(url="/messages/contacts", status_code=303)
 
 # Маршрут для разблокировки пользователя
 @router1.post("/messages/unblock/{other_user_id}")
 async def unblock_user(other_user_id: int, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        await db.execute("""
-            DELETE FROM blocked_users
-            WHERE user_id = ? AND blocked_user_id = ?
-        """, (current_user['id'], other_user_id))
-        await db.commit()
+    await write_execute("""
+        DELETE FROM blocked_users
+        WHERE user_id = ? AND blocked_user_id = ?
+    """, (current_user['id'], other_user_id))
+    block_index.unblock(current_user['id'], other_user_id)
     return RedirectResponse(url="/messages/contacts", status_code=303)
 
 # Маршрут для удаления переписки с другим пользователем
 @router1.post("/messages/delete-conversation/{other_user_id}")
 async def delete_conversation(other_user_id: int, current_user: dict = Depends(get_current_user)):
-    async with aiosqlite.connect(DATABASE) as db:
-        # Удаляем сообщения, где текущий пользователь является отправителем или получателем с данным пользователем
-        await db.execute("""
-            DELETE FROM messages
-            WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
-        """, (current_user['id'], other_user_id, other_user_id, current_user['id']))
-        await db.commit()
+    # Удаляем сообщения, где текущий пользователь является отправителем или получателем с данным пользователем
+    await _delete_conversation(current_user['id'], other_user_id)
+    message_cache.invalidate(current_user['id'], other_user_id)
     return RedirectResponse(url="/messages/contacts", status_code=303)
 
+# Страница более ранних сообщений переписки по курсору (timestamp, id)
+@router1.get("/messages/history/{other_user_id}", response_class=JSONResponse)
+async def message_history(other_user_id: int, before_timestamp: str, before_id: int, limit: int = CHAT_PAGE_SIZE, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    if other_user_id == current_user['id']:
+        return JSONResponse(content={"error": "Нельзя писать самому себе."}, status_code=400)
+
+    # Проверяем, не заблокирован ли текущий пользователь получателем
+    if await block_index.is_blocked(db, current_user['id'], other_user_id):
+        return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+    messages, has_more = await _history_page(db, current_user['id'], other_user_id, limit, (before_timestamp, before_id))
+    return JSONResponse(content={
+        "messages": [_message_dict(message) for message in messages],
+        "next_cursor": _history_cursor(messages, has_more)
+    })
+
+# Push-канал переписки (Server-Sent Events): новые сообщения приходят сразу после отправки
+@router1.get("/messages/stream/{other_user_id}")
+async def stream_messages(other_user_id: int, request: Request, since_id: int = 0, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+    if other_user_id == current_user['id']:
+        return JSONResponse(content={"error": "Нельзя писать самому себе."}, status_code=400)
+
+    # Проверяем, не заблокирован ли текущий пользователь получателем
+    if await block_index.is_blocked(db, current_user['id'], other_user_id):
+        return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
+    return _message_stream(request, current_user['id'], other_user_id, since_id)
+
 @router1.get("/messages/get/{other_user_id}", response_class=JSONResponse)
-async def get_messages(other_user_id: int, current_user: dict = Depends(get_current_user)):
+async def get_messages(other_user_id: int, request: Request, since_id: int = 0, current_user: dict = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
     if other_user_id == current_user['id']:
         return JSONResponse(content={"error": "Нельзя писать самому себе."}, status_code=400)
 
-    async with aiosqlite.connect(DATABASE) as db:
-        # Проверяем, не заблокирован ли текущий пользователь получателем
-        async with db.execute("""
-            SELECT 1 FROM blocked_users WHERE user_id = ? AND blocked_user_id = ?
-        """, (other_user_id, current_user['id'])) as cursor:
-            is_blocked = await cursor.fetchone()
-            if is_blocked:
-                return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
-        # Получаем сообщения между пользователями
-        async with db.execute("""
-            SELECT sender_id, receiver_id, content, timestamp
-            FROM messages
-            WHERE (sender_id = ? AND receiver_id = ?)
-               OR (sender_id = ? AND receiver_id = ?)
-            ORDER BY timestamp ASC
-        """, (current_user['id'], other_user_id, other_user_id, current_user['id'])) as cursor:
-            messages = await cursor.fetchall()
-        # Формируем список сообщений
-        messages_list = []
-        for msg in messages:
-            messages_list.append({
-                "sender_id": msg[0],
-                "receiver_id": msg[1],
-                "content": msg[2],
-                "timestamp": msg[3]
-            })
-    return JSONResponse(content={"messages": messages_list})
\ No newline at end of file
+    # Проверяем, не заблокирован ли текущий пользователь получателем
+    if await block_index.is_blocked(db, current_user['id'], other_user_id):
+        return JSONResponse(content={"error": "Вы не можете отправить сообщение этому пользователю."}, status_code=403)
+    # Получаем только сообщения новее курсора (since_id = 0 — вся переписка)
+    messages = await _messages_since(db, current_user['id'], other_user_id, since_id)
+    return _messages_response(request, messages, since_id)
\ No newline at end of file
@@ -0,0 +1,322 @@
+import argparse
+import asyncio
+import logging
+
+import aiosqlite
+
+from app.config import DATABASE
+from app.conversations import backfill as backfill_conversations
+from app.incident_counters import reconcile as reconcile_incident_counters
+
+logger = logging.getLogger(__name__)
+
+
+# Добавляет в таблицу отсутствующие столбцы: columns — список (имя, определение)
+def _add_columns(table: str, columns: list):
+    async def step(db: aiosqlite.Connection):
+        async with db.execute(f"PRAGMA table_info({table})") as cursor:
+            existing = {row[1] for row in await cursor.fetchall()}
+        for name, definition in columns:
+            if name not in existing:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return step
+
+
+# Связывает инциденты, созданные вместе с заявкой на услуги, с этой заявкой. Раньше связь определялась
+# совпадением request_date и created_at; здесь берется ближайшая по времени (не дальше 5 секунд)
+# еще не связанная заявка того же пользователя
+async def _link_incident_service_requests(db: aiosqlite.Connection):
+    async with db.execute(
+        "SELECT id, reporter_id, created_at FROM incidents WHERE service_request_id IS NULL ORDER BY id"
+    ) as cursor:
+        incidents = await cursor.fetchall()
+    for incident_id, reporter_id, created_at in incidents:
+        await db.execute("""
+            UPDATE incidents SET service_request_id = (
+                SELECT sr.id FROM service_requests sr
+                WHERE sr.user_id = ?
+                  AND sr.request_date BETWEEN datetime(?, '-5 seconds') AND datetime(?, '+5 seconds')
+                  AND NOT EXISTS (SELECT 1 FROM incidents i WHERE i.service_request_id = sr.id)
+                ORDER BY abs(julianday(sr.request_date) - julianday(?)), sr.id
+                LIMIT 1
+            )
+            WHERE id = ?
+        """, (reporter_id, created_at, created_at, created_at, incident_id))
+
+
+# Шаг миграции: SQL-строка или async-функция step(db).
+# Каждый шаг должен быть идемпотентным (IF NOT EXISTS, проверка наличия столбца и т.п.)
+MIGRATIONS = [
+    (1, "Индексы для частых запросов", [
+        # Переписка между двумя пользователями (чат и опрос новых сообщений)
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair_time ON messages(sender_id, receiver_id, timestamp)",
+        # Инциденты пользователя
+        "CREATE INDEX IF NOT EXISTS idx_incidents_reporter ON incidents(reporter_id)",
+        # Заявки пользователя по дате
+        "CREATE INDEX IF NOT EXISTS idx_service_requests_user_date ON service_requests(user_id, request_date)",
+        # Позиции заявки
+        "CREATE INDEX IF NOT EXISTS idx_service_cart_items_request ON service_cart_items(request_id)",
+    ]),
+    (2, "Таблица сессий", [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        # Удаление истекших сессий
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)",
+    ]),
+    (3, "Сводки переписок в conversations", [
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            FOREIGN KEY(user1_id) REFERENCES users(id) ON DELETE CASCADE,
+            FOREIGN KEY(user2_id) REFERENCES users(id) ON DELETE CASCADE,
+            UNIQUE(user1_id, user2_id)
+        )
+        """,
+        _add_columns("conversations", [
+            ("last_message_id", "INTEGER"),
+            ("last_timestamp", "TEXT"),
+            ("user1_unread", "INTEGER NOT NULL DEFAULT 0"),
+            ("user2_unread", "INTEGER NOT NULL DEFAULT 0"),
+        ]),
+        # Недавние переписки пользователя с любой стороны пары
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user1_last ON conversations(user1_id, last_timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user2_last ON conversations(user2_id, last_timestamp)",
+        backfill_conversations,
+    ]),
+    (4, "Полнотекстовый поиск по сообщениям (FTS5)", [
+        # Индекс без копии текста (external content): содержимое берется из messages
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        # Триггеры поддерживают индекс при любой вставке, удалении и изменении сообщений
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """,
+        # Индексация уже существующих сообщений
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+    ]),
+    (5, "Архив сообщений", [
+        """
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            id INTEGER PRIMARY KEY,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            is_read INTEGER NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_messages_archive_pair_time ON messages_archive(sender_id, receiver_id, timestamp)",
+        # Выбор сообщений старше срока хранения
+        "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)",
+    ]),
+    (6, "Поиск пользователей по началу имени", [
+        "CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)",
+    ]),
+    (7, "Связь инцидента с заявкой на услуги", [
+        _add_columns("incidents", [
+            ("service_request_id", "INTEGER REFERENCES service_requests(id) ON DELETE SET NULL"),
+        ]),
+        "CREATE INDEX IF NOT EXISTS idx_incidents_service_request ON incidents(service_request_id)",
+        _link_incident_service_requests,
+    ]),
+    (8, "Индексы очереди инцидентов", [
+        # Каждый статус читается по индексу уже в порядке (created_at, id); фильтры по исполнителю
+        # и автору — первые столбцы своих индексов
+        "CREATE INDEX IF NOT EXISTS idx_incidents_status_created ON incidents(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_incidents_assignee_status_created ON incidents(assignee_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_incidents_reporter_status_created ON incidents(reporter_id, status, created_at)",
+        # Список сотрудников для фильтра по исполнителю
+        "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)",
+    ]),
+    (9, "Счетчики инцидентов по статусам и исполнителям", [
+        """
+        CREATE TABLE IF NOT EXISTS incident_counters (
+            status TEXT NOT NULL,
+            assignee_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (status, assignee_id)
+        ) WITHOUT ROWID
+        """,
+        reconcile_incident_counters,
+    ]),
+    (10, "Аналитика времени решения инцидентов", [
+        # Путь статусов инцидента, например open>in_progress>closed (для старых инцидентов неизвестен)
+        _add_columns("incidents", [("status_path", "TEXT")]),
+        "UPDATE incidents SET status_path = 'open' WHERE status = 'open' AND status_path IS NULL",
+        # Инкрементальный пересчет читает инциденты, измененные после отметки
+        "CREATE INDEX IF NOT EXISTS idx_incidents_updated ON incidents(updated_at)",
+        """
+        CREATE TABLE IF NOT EXISTS resolution_facts (
+            incident_id INTEGER PRIMARY KEY,
+            assignee_id INTEGER NOT NULL,
+            week TEXT NOT NULL,
+            path TEXT NOT NULL,
+            minutes INTEGER NOT NULL,
+            bucket INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resolution_histogram (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            minutes INTEGER NOT NULL,
+            PRIMARY KEY (dimension, key, bucket)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS analytics_state (
+            name TEXT PRIMARY KEY,
+            updated_at TEXT NOT NULL,
+            incident_id INTEGER NOT NULL
+        )
+        """,
+    ]),
+    (11, "Полнотекстовый поиск по инцидентам (FTS5)", [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS incidents_fts USING fts5(
+            title, description, content='incidents', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3 4'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS incidents_fts_insert AFTER INSERT ON incidents BEGIN
+            INSERT INTO incidents_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS incidents_fts_delete AFTER DELETE ON incidents BEGIN
+            INSERT INTO incidents_fts(incidents_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+        END
+        """,
+        # Смена статуса и исполнителя индекс не трогает
+        """
+        CREATE TRIGGER IF NOT EXISTS incidents_fts_update AFTER UPDATE OF title, description ON incidents BEGIN
+            INSERT INTO incidents_fts(incidents_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO incidents_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END
+        """,
+        "INSERT INTO incidents_fts(incidents_fts) VALUES ('rebuild')",
+    ]),
+    (12, "Журнал изменений инцидентов", [
+        """
+        CREATE TABLE IF NOT EXISTS incident_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            incident_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            status TEXT,
+            assignee_id INTEGER,
+            created_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_incident_events_incident ON incident_events(incident_id, id)",
+        # Существующие инциденты попадают в журнал событием created с их текущим состоянием
+        """
+        INSERT INTO incident_events (incident_id, event, status, assignee_id, created_at)
+        SELECT i.id, 'created', i.status, i.assignee_id, i.created_at
+        FROM incidents i
+        WHERE NOT EXISTS (SELECT 1 FROM incident_events e WHERE e.incident_id = i.id)
+        ORDER BY i.id
+        """,
+    ]),
+    (13, "Корзины аналитики времени решения с тремя значащими цифрами", [
+        # Корзины считаются при заполнении фактов: без отметки следующее обновление аналитики сделает полный пересчет
+        "DELETE FROM resolution_facts",
+        "DELETE FROM resolution_histogram",
+        "DELETE FROM analytics_state WHERE name = 'resolution'",
+    ]),
+]
+
+
+async def _ensure_version_table(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    """)
+
+
+async def current_version(db: aiosqlite.Connection) -> int:
+    await _ensure_version_table(db)
+    async with db.execute("SELECT MAX(version) FROM schema_version") as cursor:
+        row = await cursor.fetchone()
+    return row[0] or 0
+
+
+# Применяет недостающие миграции по порядку; каждая миграция — отдельная транзакция
+async def migrate(database: str = DATABASE) -> list:
+    applied = []
+    async with aiosqlite.connect(database, isolation_level=None) as db:
+        await db.execute("PRAGMA busy_timeout = 5000")
+        for version, description, steps in MIGRATIONS:
+            # Блокировка на запись берется до проверки версии, чтобы параллельный запуск
+            # (например, app и app1) не применил миграцию дважды
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                if version <= await current_version(db):
+                    await db.rollback()
+                    continue
+                for step in steps:
+                    if callable(step):
+                        await step(db)
+                    else:
+                        await db.execute(step)
+                await db.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, datetime('now'))",
+                    (version, description)
+                )
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                logger.error(f"Ошибка при применении миграции {version}: {description}")
+                raise
+            logger.info(f"Применена миграция {version}: {description}")
+            applied.append(version)
+    return applied
+
+
+async def status(database: str = DATABASE) -> list:
+    async with aiosqlite.connect(database) as db:
+        version = await current_version(db)
+    return [(v, description, v <= version) for v, description, _ in MIGRATIONS]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    parser.add_argument("--database", default=DATABASE, help="Путь к файлу базы данных")
+    parser.add_argument("--status", action="store_true", help="Показать состояние миграций без применения")
+    args = parser.parse_args()
+    if args.status:
+        for v, description, done in asyncio.run(status(args.database)):
+            print(f"{v:4d}  {'применена' if done else 'ожидает  '}  {description}")
+    else:
+        applied = asyncio.run(migrate(args.database))
+        print(f"Применено миграций: {len(applied)}")
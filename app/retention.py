@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import aiosqlite
+
+from app import db as appdb
+from app.config import (
+    MESSAGE_RETENTION_DAYS, MESSAGE_RETENTION_BATCH_SIZE, MESSAGE_RETENTION_INTERVAL, MESSAGE_RETENTION_PAUSE,
+)
+from app.chat_cache import message_cache
+
+logger = logging.getLogger(__name__)
+
+# Сообщения старше срока хранения переносятся из messages в messages_archive (та же база),
+# чтобы горячая таблица и ее индексы оставались небольшими
+
+ARCHIVE_COLUMNS = "id, sender_id, receiver_id, content, timestamp, is_read"
+
+
+def retention_cutoff(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Переносит в архив не больше batch_size сообщений старше cutoff (одна короткая транзакция).
+# Возвращает (число перенесенных, пары собеседников). Триггеры messages_fts удаляют
+# перенесенные сообщения из поискового индекса
+async def archive_batch(db: aiosqlite.Connection, cutoff: str, batch_size: int):
+    async with db.execute(
+        "SELECT id, sender_id, receiver_id FROM messages WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+        (cutoff, batch_size),
+    ) as cursor:
+        rows = await cursor.fetchall()
+    if not rows:
+        return 0, []
+    ids = [row[0] for row in rows]
+    placeholders = ", ".join("?" * len(ids))
+    await db.execute(f"""
+        INSERT INTO messages_archive ({ARCHIVE_COLUMNS}, archived_at)
+        SELECT {ARCHIVE_COLUMNS}, datetime('now') FROM messages WHERE id IN ({placeholders})
+    """, ids)
+    await db.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", ids)
+    return len(ids), list({(row[1], row[2]) for row in rows})
+
+
+# Архивирует все сообщения старше days дней пачками: каждая пачка — отдельное задание writer,
+# между пачками пауза, чтобы запись сообщений и остальные задания не ждали всей архивации
+async def archive_old_messages(
+    days: int = MESSAGE_RETENTION_DAYS,
+    batch_size: int = MESSAGE_RETENTION_BATCH_SIZE,
+    pause: float = MESSAGE_RETENTION_PAUSE,
+) -> int:
+    cutoff = retention_cutoff(days)
+    archived = 0
+    while True:
+        count, pairs = await appdb.write(archive_batch, cutoff, batch_size)
+        archived += count
+        for sender_id, receiver_id in pairs:
+            message_cache.invalidate(sender_id, receiver_id)
+        if count < batch_size:
+            return archived
+        await asyncio.sleep(pause)
+
+
+# Периодическая архивация в фоне процесса; запускается и останавливается из lifespan приложений
+# (app и app1 в одном процессе делят одну задачу). При MESSAGE_RETENTION_DAYS = 0 не запускается
+class RetentionWorker:
+    def __init__(self, days: int, interval: float):
+        self.days = days
+        self.interval = interval
+        self._task = None
+        self._users = 0
+        self.runs = 0
+        self.archived = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_duration = None
+
+    def start(self):
+        self._users += 1
+        if self.days > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._users = max(self._users - 1, 0)
+        if self._users or self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def run_once(self) -> int:
+        started = time.perf_counter()
+        try:
+            archived = await archive_old_messages(self.days)
+        except Exception:
+            self.errors += 1
+            raise
+        self.runs += 1
+        self.archived += archived
+        self.last_run = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self.last_duration = round(time.perf_counter() - started, 3)
+        if archived:
+            logger.info(f"Перенесено в архив сообщений: {archived}")
+        return archived
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка архивации сообщений: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "days": self.days,
+            "interval": self.interval,
+            "running": self._task is not None,
+            "runs": self.runs,
+            "archived": self.archived,
+            "errors": self.errors,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+        }
+
+
+message_retention = RetentionWorker(MESSAGE_RETENTION_DAYS, MESSAGE_RETENTION_INTERVAL)
+
+
+async def run_archive(days: int, batch_size: int) -> int:
+    try:
+        return await archive_old_messages(days, batch_size)
+    finally:
+        await appdb.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Перенос старых сообщений в архив (таблица messages_archive)")
+    parser.add_argument("--days", type=int, default=MESSAGE_RETENTION_DAYS or 365, help="Срок хранения сообщений, дней")
+    parser.add_argument("--batch-size", type=int, default=MESSAGE_RETENTION_BATCH_SIZE, help="Сообщений в одной транзакции")
+    args = parser.parse_args()
+    count = asyncio.run(run_archive(args.days, args.batch_size))
+    print(f"Перенесено в архив сообщений: {count}")
@@ -0,0 +1,40 @@
+import html
+
+# Маркеры выделения во фрагментах snippet(): управляющие символы, которых нет в тексте,
+# чтобы экранировать фрагмент целиком и только потом вставить теги выделения
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+
+# Превращает пользовательский ввод в запрос FTS5: каждое слово — отдельная фраза в кавычках
+# (синтаксис FTS5 во вводе не интерпретируется, все слова обязательны), последнее ищется по префиксу,
+# если в нем не меньше min_prefix символов. Возвращает None, если искать нечего
+def fts_query(text: str, min_prefix: int = 1):
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if len(words[-1]) >= min_prefix:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+# Экранирует фрагмент и заменяет маркеры на <mark>
+def snippet_html(snippet: str) -> str:
+    return html.escape(snippet or "").replace(SNIPPET_START, "<mark>").replace(SNIPPET_END, "</mark>")
+
+
+# Релевантность по текстам колонок с маркерами highlight(): BM25 без IDF (все строки содержат все слова запроса,
+# поэтому IDF лишь перераспределяет веса между словами). Частота — число выделений в колонке, длина — число слов,
+# средняя длина — по переданным строкам. rows — кортежи текстов колонок, weights — веса колонок
+def marked_scores(rows: list, weights: tuple, k1: float = 1.2, b: float = 0.75) -> list:
+    lengths = [[len((text or "").split()) for text in row] for row in rows]
+    averages = [max(sum(column) / len(rows), 1) for column in zip(*lengths)] if rows else []
+    scores = []
+    for row, row_lengths in zip(rows, lengths):
+        score = 0.0
+        for text, length, average, weight in zip(row, row_lengths, averages, weights):
+            frequency = (text or "").count(SNIPPET_START)
+            score += weight * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * length / average))
+        scores.append(score)
+    return scores
@@ -0,0 +1,59 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import PASSWORD_HASH_ITERATIONS, PASSWORD_HASH_WORKERS
+
+ALGORITHM = "pbkdf2_sha256"
+
+# Хеширование выполняется в ограниченном пуле потоков: hashlib освобождает GIL,
+# поэтому вход пользователей не блокирует цикл событий и остальные запросы.
+# PASSWORD_HASH_WORKERS = 0 — хеширование прямо в цикле событий (только для сравнения в бенчмарке)
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash") if PASSWORD_HASH_WORKERS else None
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _derive(password: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+
+
+async def _run(func, *args):
+    if _executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith(ALGORITHM + "$")
+
+
+# Возвращает строку вида pbkdf2_sha256$<итерации>$<соль>$<хеш>
+async def hash_password(password: str, iterations: int = PASSWORD_HASH_ITERATIONS) -> str:
+    salt = secrets.token_bytes(16)
+    digest = await _run(_derive, password, salt, iterations)
+    return f"{ALGORITHM}${iterations}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+# Возвращает (пароль верен, нужно ли пересохранить хеш).
+# Пароли, сохраненные открытым текстом, принимаются и помечаются для обновления
+async def verify_password(password: str, stored: str):
+    if not is_hashed(stored):
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8")), True
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        iterations = int(iterations)
+        salt, digest = _b64decode(salt), _b64decode(digest)
+    except ValueError:
+        return False, False
+    candidate = await _run(_derive, password, salt, iterations)
+    return hmac.compare_digest(candidate, digest), iterations != PASSWORD_HASH_ITERATIONS
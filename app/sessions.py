@@ -0,0 +1,260 @@
+import asyncio
+import json
+import logging
+import secrets
+import time
+from collections import OrderedDict
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+
+from app.config import (
+    SESSION_BACKEND, SESSION_COOKIE, SESSION_MAX_AGE, SESSION_HTTPS_ONLY,
+    SESSION_MEMORY_MAX_SESSIONS, SESSION_PURGE_INTERVAL
+)
+from app.db import pool, write, write_execute
+
+logger = logging.getLogger(__name__)
+
+
+# Данные сессии запроса (request.session). Изменение через методы словаря помечает сессию измененной;
+# вложенные объекты нужно присваивать заново (session['cart'] = cart) или вызвать mark_dirty()
+class Session(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = False
+        self.regenerated = False
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    # Выдать сессии новый идентификатор при сохранении (старая запись удаляется). Вызывается при входе,
+    # чтобы идентификатор, известный до входа (фиксация сессии), не получил доступ к учетной записи
+    def regenerate(self):
+        self.regenerated = True
+        self.dirty = True
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty = True
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty = True
+
+    def clear(self):
+        if self:
+            self.dirty = True
+        super().clear()
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty = True
+        return super().pop(key, *default)
+
+    def popitem(self):
+        self.dirty = True
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.dirty = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.dirty = True
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+# Хранилище в памяти процесса: для одного процесса и разработки.
+# Число сессий ограничено, давно не использованные вытесняются
+class MemorySessionBackend:
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._data = OrderedDict()
+        self.loads = 0
+        self.saves = 0
+        self.deletes = 0
+
+    # Возвращает (данные, момент истечения) или None
+    async def load(self, session_id: str):
+        self.loads += 1
+        item = self._data.get(session_id)
+        if item is None:
+            return None
+        expires_at, data = item
+        if expires_at <= time.time():
+            del self._data[session_id]
+            return None
+        self._data.move_to_end(session_id)
+        return json.loads(data), expires_at
+
+    async def save(self, session_id: str, data: dict, expires_at: float):
+        self.saves += 1
+        # Хранится сериализованная копия, чтобы запросы не делили изменяемые объекты
+        self._data[session_id] = (expires_at, _dumps(data))
+        self._data.move_to_end(session_id)
+        while len(self._data) > self.max_sessions:
+            self._data.popitem(last=False)
+
+    async def delete(self, session_id: str):
+        self.deletes += 1
+        self._data.pop(session_id, None)
+
+    async def purge_expired(self) -> int:
+        now = time.time()
+        expired = [session_id for session_id, (expires_at, _) in self._data.items() if expires_at <= now]
+        for session_id in expired:
+            del self._data[session_id]
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "sessions": len(self._data), "loads": self.loads, "saves": self.saves, "deletes": self.deletes}
+
+
+# Хранилище в таблице sessions: общее для нескольких процессов (app и app1).
+# Чтение — через пул, запись — через writer
+class SQLiteSessionBackend:
+    def __init__(self):
+        self.loads = 0
+        self.saves = 0
+        self.deletes = 0
+
+    async def load(self, session_id: str):
+        self.loads += 1
+        async with pool.acquire() as db:
+            async with db.execute(
+                "SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?", (session_id, time.time())
+            ) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    async def save(self, session_id: str, data: dict, expires_at: float):
+        self.saves += 1
+        await write_execute(
+            "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+            (session_id, _dumps(data), expires_at)
+        )
+
+    async def delete(self, session_id: str):
+        self.deletes += 1
+        await write_execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    async def purge_expired(self) -> int:
+        async def job(db):
+            cursor = await db.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+            return cursor.rowcount
+        return await write(job)
+
+    def stats(self) -> dict:
+        return {"backend": "sqlite", "loads": self.loads, "saves": self.saves, "deletes": self.deletes}
+
+
+def create_backend(name: str = SESSION_BACKEND):
+    if name == "memory":
+        return MemorySessionBackend(SESSION_MEMORY_MAX_SESSIONS)
+    if name == "sqlite":
+        return SQLiteSessionBackend()
+    raise ValueError(f"Неизвестное хранилище сессий: {name}")
+
+
+session_backend = create_backend()
+
+
+# ASGI middleware вместо starlette SessionMiddleware: в cookie хранится только случайный идентификатор,
+# данные — в хранилище. Запись выполняется только для измененных сессий (и для продления срока,
+# когда прошло больше половины max_age). Для путей из skip_prefixes (статика) сессия не загружается
+class SessionMiddleware:
+    def __init__(
+        self,
+        app,
+        backend=None,
+        session_cookie: str = SESSION_COOKIE,
+        max_age: int = SESSION_MAX_AGE,
+        https_only: bool = SESSION_HTTPS_ONLY,
+        purge_interval: float = SESSION_PURGE_INTERVAL,
+        skip_prefixes: tuple = ("/static/",),
+    ):
+        self.app = app
+        self.backend = backend or session_backend
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.security_flags = "httponly; samesite=lax" + ("; secure" if https_only else "")
+        self.purge_interval = purge_interval
+        self.skip_prefixes = skip_prefixes
+        self._next_purge = time.monotonic() + purge_interval
+        self._purge_task = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or scope["path"].startswith(self.skip_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        self._maybe_purge()
+        session_id = HTTPConnection(scope).cookies.get(self.session_cookie)
+        expires_at = None
+        session = Session()
+        if session_id:
+            loaded = await self.backend.load(session_id)
+            if loaded is None:
+                session_id = None
+            else:
+                data, expires_at = loaded
+                session = Session(data)
+        scope["session"] = session
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                cookie = await self._commit(session_id, session, expires_at)
+                if cookie:
+                    MutableHeaders(scope=message).append("Set-Cookie", cookie)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    # Сохраняет сессию при необходимости; возвращает значение заголовка Set-Cookie или None
+    async def _commit(self, session_id, session: Session, expires_at):
+        now = time.time()
+        if session.dirty and not session:
+            if not session_id:
+                return None
+            await self.backend.delete(session_id)
+            return self._cookie("null", 0)
+        if session.regenerated:
+            session.regenerated = False
+            if session_id:
+                await self.backend.delete(session_id)
+                session_id = None
+        refresh = session_id and session and expires_at - now < self.max_age / 2
+        if not session.dirty and not refresh:
+            return None
+        session_id = session_id or secrets.token_urlsafe(32)
+        await self.backend.save(session_id, session, now + self.max_age)
+        session.dirty = False
+        return self._cookie(session_id, self.max_age)
+
+    def _cookie(self, value: str, max_age: int) -> str:
+        return f"{self.session_cookie}={value}; path=/; Max-Age={max_age}; {self.security_flags}"
+
+    # Периодически удаляет истекшие сессии в фоне, не задерживая запрос
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if now < self._next_purge or (self._purge_task is not None and not self._purge_task.done()):
+            return
+        self._next_purge = now + self.purge_interval
+        self._purge_task = asyncio.create_task(self._purge())
+
+    async def _purge(self):
+        try:
+            removed = await self.backend.purge_expired()
+            if removed:
+                logger.info(f"Удалено истекших сессий: {removed}")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении истекших сессий: {e}")
@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict, deque
+
+
+# Ограничитель попыток со скользящим окном: не более limit событий за window секунд на ключ.
+# Память ограничена: у ключа хранится не больше limit отметок, ключей — не больше max_keys
+# (давно не использованные вытесняются), просроченные ключи периодически удаляются
+class SlidingWindowLimiter:
+    def __init__(self, limit: int, window: float, max_keys: int, sweep_interval: float):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self._hits = OrderedDict()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    # Возвращает 0, если попытка разрешена (и учитывает ее), иначе — через сколько секунд можно повторить
+    def hit(self, key) -> float:
+        now = time.monotonic()
+        self._maybe_sweep(now)
+        hits = self._hits.get(key)
+        if hits is None:
+            hits = deque(maxlen=self.limit)
+            self._hits[key] = hits
+            while len(self._hits) > self.max_keys:
+                self._hits.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._hits.move_to_end(key)
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+        if len(hits) >= self.limit:
+            self.rejected += 1
+            return hits[0] + self.window - now
+        hits.append(now)
+        self.allowed += 1
+        return 0.0
+
+    # Отменяет последнее учтенное событие ключа (попытка оказалась не той, что нужно ограничивать)
+    def refund(self, key):
+        hits = self._hits.get(key)
+        if hits:
+            hits.pop()
+            if not hits:
+                del self._hits[key]
+
+    def reset(self, key):
+        self._hits.pop(key, None)
+
+    def _maybe_sweep(self, now: float):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        expired = [key for key, hits in self._hits.items() if not hits or hits[-1] <= now - self.window]
+        for key in expired:
+            del self._hits[key]
+        self.evicted += len(expired)
+
+    def __len__(self):
+        return len(self._hits)
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._hits),
+            "max_keys": self.max_keys,
+            "limit": self.limit,
+            "window": self.window,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,127 @@
+"""Бенчмарк входа: пропускная способность логинов и задержка посторонних запросов во время них.
+
+Запуск из корня репозитория:
+    python -m benchmarks.login_throughput --users 50 --concurrency 16 --duration 10
+    python -m benchmarks.login_throughput --workers 0   # хеширование в цикле событий, для сравнения
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк входа пользователей")
+    parser.add_argument("--users", type=int, default=50, help="Число тестовых пользователей")
+    parser.add_argument("--concurrency", type=int, default=16, help="Одновременных попыток входа")
+    parser.add_argument("--duration", type=float, default=10.0, help="Длительность замера, с")
+    parser.add_argument("--iterations", type=int, default=None, help="Итерации PBKDF2 (по умолчанию из config)")
+    parser.add_argument("--workers", type=int, default=None, help="Потоков для хеширования (0 — в цикле событий)")
+    parser.add_argument("--probe-interval", type=float, default=0.01, help="Пауза между посторонними запросами, с")
+    return parser.parse_args()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run(args):
+    # Модули приложения читают настройки при импорте, поэтому импортируются после настройки окружения
+    import httpx
+    from database.init_db import init_db
+    from app import db
+    from app.main import app1
+    from app.security import hash_password
+
+    # Логирование каждого запроса искажает замер
+    logging.getLogger().setLevel(logging.WARNING)
+    await init_db(os.environ["ITSM_DATABASE"])
+    password = "benchmark-password"
+    stored = await hash_password(password)
+    for i in range(args.users):
+        await db.write_execute(
+            "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, 'user')",
+            (f"bench{i}", f"bench{i}@example.com", stored)
+        )
+    await db.write_execute(
+        "INSERT INTO users (username, email, password, role) VALUES ('bench-probe', 'bench-probe@example.com', ?, 'user')",
+        (stored,)
+    )
+
+    transport = httpx.ASGITransport(app=app1)
+    logins, failures, throttled, probe_latencies = [], 0, 0, []
+
+    async def login_worker(n):
+        nonlocal failures, throttled
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            i = n
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                response = await client.post("/login", data={"username": f"bench{i % args.users}", "password": password})
+                if response.status_code == 303:
+                    logins.append(time.perf_counter() - started)
+                elif response.status_code == 429:
+                    throttled += 1
+                else:
+                    failures += 1
+                client.cookies.clear()
+                i += args.concurrency
+
+    async def probe(client):
+        # Посторонний запрос без обращения к паролям, но с сессией и чтением из пула:
+        # показывает, не блокируются ли цикл событий и пул соединений на время входов
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = await client.get("/incidents/my")
+            response.raise_for_status()
+            probe_latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(args.probe_interval)
+
+    await db.startup()
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as probe_client:
+            response = await probe_client.post("/login", data={"username": "bench-probe", "password": password})
+            if response.status_code != 303:
+                raise RuntimeError(f"Не удалось войти пользователем для посторонних запросов: {response.status_code}")
+            deadline = time.perf_counter() + args.duration
+            started = time.perf_counter()
+            await asyncio.gather(probe(probe_client), *(login_worker(n) for n in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await db.shutdown()
+
+    print(f"Итераций PBKDF2: {os.environ.get('ITSM_PASSWORD_HASH_ITERATIONS', 'по умолчанию')}, "
+          f"потоков хеширования: {os.environ.get('ITSM_PASSWORD_HASH_WORKERS', 'по умолчанию')}")
+    print(f"Успешных входов: {len(logins)} за {elapsed:.1f} с — {len(logins) / elapsed:.1f} входов/с, "
+          f"отклонено ограничением (429): {throttled}, ошибок: {failures}")
+    if logins:
+        print(f"Задержка входа: p50 {statistics.median(logins) * 1000:.1f} мс, p99 {percentile(logins, 99) * 1000:.1f} мс")
+    print(f"Посторонние запросы: {len(probe_latencies)}, p50 {statistics.median(probe_latencies) * 1000:.1f} мс, "
+          f"p99 {percentile(probe_latencies, 99) * 1000:.1f} мс")
+    return throttled
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="itsm-bench-")
+    os.environ["ITSM_DATABASE"] = os.path.join(workdir, "bench.db")
+    os.environ["ITSM_DB_MIGRATE_ON_STARTUP"] = "0"
+    if args.iterations is not None:
+        os.environ["ITSM_PASSWORD_HASH_ITERATIONS"] = str(args.iterations)
+    if args.workers is not None:
+        os.environ["ITSM_PASSWORD_HASH_WORKERS"] = str(args.workers)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    # Все входы бенчмарка успешные и идут с одного адреса: ограничение попыток не должно их отклонять
+    if asyncio.run(run(args)):
+        sys.exit("Успешные входы отклонены ограничением попыток входа")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,14 @@ import sqlite3
 import aiosqlite
 import asyncio
 from app.config import DATABASE
+from app.migrations import migrate
 
-async def init_db():
-    async with aiosqlite.connect('database.db') as db:
+async def init_db(database: str = DATABASE):
+    async with aiosqlite.connect(database) as db:
         # Enable foreign key support
         await db.execute("PRAGMA foreign_keys = ON;")
+        # WAL: читатели не блокируются пишущей транзакцией
+        await db.execute("PRAGMA journal_mode = WAL;")
 
         # Users table
         await db.execute("""
@@ -107,6 +110,9 @@ async def init_db():
 
         await db.commit()
 
+    # Индексы и последующие изменения схемы
+    await migrate(database)
+
 
 async def change_user_role(username: str, new_role: str):
     allowed_roles = ['user', 'employee', 'admin']
@@ -120,7 +126,10 @@ async def change_user_role(username: str, new_role: str):
             if user:
                 await db.execute("UPDATE users SET role = ? WHERE username = ?", (new_role, username))
                 await db.commit()
+                # Утилита работает в отдельном процессе и не может сбросить кэш пользователей запущенного сервера:
+                # новая роль вступит в силу после истечения USER_CACHE_TTL или перезапуска сервера
                 print(f"Роль пользователя '{username}' успешно изменена на '{new_role}'.")
+                print("Запущенный сервер применит новую роль после истечения USER_CACHE_TTL или перезапуска.")
             else:
                 raise ValueError(f"Пользователь с логином '{username}' не найден.")
 